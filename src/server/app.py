@@ -4,6 +4,7 @@ from flask import Flask, request, Response, send_from_directory
 from flask_cors import CORS
 import requests
 from openai import OpenAI  # Import OpenAI client
+from response_cache import ResponseCache, cache_key
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -18,8 +19,40 @@ MODEL_NAME = "gpt-4o-mini"  # OpenAI's GPT-4o mini model
 SYSTEM_PROMPT = "You are Theta, an AI tutor created by Theta Summary. You are helpful, patient, and aim to explain concepts clearly and encourage learning."
 MAX_TOKENS = 1024  # Max tokens for the AI's response
 
+# Complete answers are replayed for repeated questions; 0 entries keeps them on disk only
+RESPONSE_CACHE_ENTRIES = int(os.getenv('RESPONSE_CACHE_ENTRIES', '1000'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '86400'))  # seconds
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH')  # SQLite file for the on-disk tier; unset for none
+
 # Initialize OpenAI client
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
+response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH)
+
+def sse_event(data):
+    """Format one Server-Sent Events frame; asgi_app.py sends the same frames"""
+    return f"data: {json.dumps(data)}\n\n"
+
+def replay_cached(chunks):
+    """Send a cached answer as the same frames as a live stream"""
+    for chunk in chunks:
+        yield sse_event({'chunk': chunk})
+    yield sse_event({'done': True})
+
+def build_messages(user_message, history_param):
+    """System prompt, the conversation history passed as JSON (if valid) and the new message"""
+    if history_param:
+        try:
+            history = json.loads(history_param)
+        except json.JSONDecodeError:
+            history = []
+    else:
+        history = []
+
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT}
+    ] + history + [
+        {"role": "user", "content": user_message}
+    ]
 
 # --- Static File Serving ---
 @app.route('/')
@@ -39,35 +72,28 @@ def chat_stream():
     if not user_message:
         def error_stream_no_message():
             error_data = {"error": "No message provided in query parameters"}
-            yield f"data: {json.dumps(error_data)}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield sse_event(error_data)
+            yield sse_event({'done': True})
         return Response(error_stream_no_message(), mimetype='text/event-stream')
 
     if not OPENAI_API_KEY:
         def error_stream_no_key():
             error_data = {"error": "API key not configured on the server"}
-            yield f"data: {json.dumps(error_data)}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield sse_event(error_data)
+            yield sse_event({'done': True})
         return Response(error_stream_no_key(), mimetype='text/event-stream')
 
-    # Parse conversation history if provided
-    history_param = request.args.get('history')
-    if history_param:
-        try:
-            history = json.loads(history_param)
-        except json.JSONDecodeError:
-            history = []
-    else:
-        history = []
+    # Create messages for OpenAI API, with the conversation history if provided
+    messages = build_messages(user_message, request.args.get('history'))
 
-    # Create messages for OpenAI API
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT}
-    ] + history + [
-        {"role": "user", "content": user_message}
-    ]
+    # Repeated questions are answered from the cache without calling OpenAI
+    key = cache_key(messages, MODEL_NAME, MAX_TOKENS)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return Response(replay_cached(cached), mimetype='text/event-stream')
 
     def generate_sse_from_openai():
+        chunks = []
         try:
             print(f"Calling OpenAI with message: {user_message}")
             
@@ -85,26 +111,35 @@ def chat_stream():
                     delta_content = chunk.choices[0].delta.content
                     if delta_content:
                         # Send the chunk of content
-                        yield f"data: {json.dumps({'chunk': delta_content})}\n\n"
+                        chunks.append(delta_content)
+                        yield sse_event({'chunk': delta_content})
                     
                     # Check if this is the final message
                     if chunk.choices[0].finish_reason:
                         print(f"OpenAI indicated finish_reason: {chunk.choices[0].finish_reason}")
                         break
             
+            # Only complete answers are cached
+            response_cache.put(key, chunks)
+
             # Send done message
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield sse_event({'done': True})
             
         except Exception as e:
             print(f"Error streaming from OpenAI: {e}")
             error_data = {"error": f"Error processing request: {str(e)}"}
-            yield f"data: {json.dumps(error_data)}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield sse_event(error_data)
+            yield sse_event({'done': True})
         finally:
             print("[APP.PY] generate_sse_from_openai finished.")
 
     return Response(generate_sse_from_openai(), mimetype='text/event-stream')
 
+# --- Response cache hit/miss counters ---
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return response_cache.stats()
+
 # --- Text-to-Speech API for Voice Mode ---
 @app.route('/tts', methods=['POST'])
 def text_to_speech():
@@ -0,0 +1,174 @@
+"""Async (ASGI) serving mode for the Theta tutor bot.
+
+Serves the same routes and Server-Sent Events frames as app.py, but /chat and /tts
+call OpenAI through AsyncOpenAI on an event loop, so an open chat stream does not
+hold a worker thread and one process can serve hundreds of streams at once.
+
+Run it with Hypercorn:
+
+    hypercorn asgi_app:app --bind 0.0.0.0:5000
+
+or with `python asgi_app.py`, which does the same.
+"""
+import asyncio
+import os
+
+import httpx
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from openai import AsyncOpenAI
+from quart import Quart, request, Response, send_from_directory
+from quart_cors import cors
+
+from app import (OPENAI_API_KEY, OPENAI_VOICE_API_KEY, MODEL_NAME, MAX_TOKENS, build_messages, sse_event,
+                 response_cache)
+from response_cache import cache_key
+
+app = cors(Quart(__name__), allow_origin='*')  # Enable CORS for all routes
+# Completions often stream for longer than Quart's default 60 second response timeout
+app.config['RESPONSE_TIMEOUT'] = None
+
+# --- Configuration ---
+# Connections each OpenAI client may open, i.e. the number of concurrent streams
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '500'))
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '5000'))
+
+def _async_client(api_key):
+    limits = httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=100)
+    return AsyncOpenAI(api_key=api_key, http_client=httpx.AsyncClient(limits=limits, timeout=600))
+
+# Initialize OpenAI clients
+openai_client = _async_client(OPENAI_API_KEY)
+voice_client = _async_client(OPENAI_VOICE_API_KEY)
+
+# --- Static File Serving ---
+@app.route('/')
+async def index():
+    return await send_from_directory('.', 'index.html')
+
+@app.route('/<path:path>')
+async def static_files(path):
+    # This will serve script.js, style.css, etc.
+    return await send_from_directory('.', path)
+
+# --- Chat Endpoint (Server-Sent Events) ---
+@app.route('/chat', methods=['GET'])
+async def chat_stream():
+    user_message = request.args.get('message')
+
+    if not user_message:
+        async def error_stream_no_message():
+            yield sse_event({"error": "No message provided in query parameters"})
+            yield sse_event({'done': True})
+        return Response(error_stream_no_message(), mimetype='text/event-stream')
+
+    if not OPENAI_API_KEY:
+        async def error_stream_no_key():
+            yield sse_event({"error": "API key not configured on the server"})
+            yield sse_event({'done': True})
+        return Response(error_stream_no_key(), mimetype='text/event-stream')
+
+    # Create messages for OpenAI API, with the conversation history if provided
+    messages = build_messages(user_message, request.args.get('history'))
+
+    # Repeated questions are answered from the cache without calling OpenAI. The cache
+    # takes a lock and may read SQLite, so it runs on a thread, off the event loop
+    key = cache_key(messages, MODEL_NAME, MAX_TOKENS)
+    cached = await asyncio.to_thread(response_cache.get, key)
+    if cached is not None:
+        async def replay_cached():
+            for chunk in cached:
+                yield sse_event({'chunk': chunk})
+            yield sse_event({'done': True})
+        return Response(replay_cached(), mimetype='text/event-stream')
+
+    async def generate_sse_from_openai():
+        stream = None
+        chunks = []
+        try:
+            print(f"Calling OpenAI with message: {user_message}")
+
+            # Make a streaming request to OpenAI API
+            stream = await openai_client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                stream=True,
+                max_tokens=MAX_TOKENS
+            )
+
+            async for chunk in stream:
+                if chunk.choices:
+                    # Extract the content from delta
+                    delta_content = chunk.choices[0].delta.content
+                    if delta_content:
+                        # Send the chunk of content
+                        chunks.append(delta_content)
+                        yield sse_event({'chunk': delta_content})
+
+                    # Check if this is the final message
+                    if chunk.choices[0].finish_reason:
+                        print(f"OpenAI indicated finish_reason: {chunk.choices[0].finish_reason}")
+                        break
+
+            # Only complete answers are cached
+            await asyncio.to_thread(response_cache.put, key, chunks)
+
+            # Send done message
+            yield sse_event({'done': True})
+
+        except asyncio.CancelledError:
+            # The student closed the stream
+            raise
+        except Exception as e:
+            print(f"Error streaming from OpenAI: {e}")
+            yield sse_event({"error": f"Error processing request: {str(e)}"})
+            yield sse_event({'done': True})
+        finally:
+            # Give the OpenAI connection back to the pool, also when the client went away mid-stream
+            if stream is not None:
+                await stream.response.aclose()
+            print("[ASGI_APP.PY] generate_sse_from_openai finished.")
+
+    return Response(generate_sse_from_openai(), mimetype='text/event-stream')
+
+# --- Response cache hit/miss counters ---
+@app.route('/cache/stats', methods=['GET'])
+async def cache_stats():
+    return await asyncio.to_thread(response_cache.stats)
+
+# --- Text-to-Speech API for Voice Mode ---
+@app.route('/tts', methods=['POST'])
+async def text_to_speech():
+    try:
+        # Get text from request
+        data = await request.get_json()
+        text = data.get('text')
+
+        if not text:
+            return {"error": "No text provided"}, 400
+
+        # Call OpenAI TTS API
+        response = await voice_client.audio.speech.create(
+            model="tts-1",
+            voice="alloy",
+            input=text
+        )
+
+        # Return audio as a response
+        return Response(response.content, mimetype='audio/mpeg')
+
+    except Exception as e:
+        print(f"Error generating speech: {e}")
+        return {"error": f"Failed to generate speech: {str(e)}"}, 500
+
+if __name__ == '__main__':
+    print("Starting ASGI app for Theta tutor bot...")
+    if not OPENAI_API_KEY:
+        print("Warning: OPENAI_API_KEY is not set or empty.")
+    else:
+        print("OPENAI_API_KEY is set.")
+    config = Config()
+    config.bind = [f"{HOST}:{PORT}"]
+    print(f"Open http://127.0.0.1:{PORT} in your browser.")
+    asyncio.run(serve(app, config))
@@ -0,0 +1,107 @@
+"""Cache of complete tutor answers, so a repeated question is replayed without calling OpenAI.
+
+An answer is stored as the list of chunks it was streamed in, so a hit is sent as the
+same SSE frames. Entries live in memory (least recently used dropped first) and,
+optionally, in a SQLite file that survives restarts and is shared by every process
+on the machine. Both tiers expire entries after the TTL.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+def _normalize(text):
+    """Questions that differ only in case or whitespace share an answer"""
+    return " ".join(str(text).split()).casefold()
+
+def cache_key(messages, model, max_tokens):
+    """Key for a completion: the normalized messages (system prompt, history and question), model and max tokens"""
+    normalized = [[message.get('role'), _normalize(message.get('content', ''))] if isinstance(message, dict)
+                  else _normalize(message) for message in messages]
+    payload = json.dumps([normalized, model, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    # Expired rows are deleted from the disk tier every this many puts
+    PURGE_EVERY = 100
+
+    def __init__(self, max_entries=1000, ttl=86400, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored at, chunks), least recently used first
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                             "(key TEXT PRIMARY KEY, chunks TEXT NOT NULL, stored_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS ix_responses_stored_at ON responses (stored_at)")
+            self._db.commit()
+
+    def get(self, key):
+        """The cached chunks for key, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT chunks, stored_at FROM responses WHERE key = ? AND stored_at > ?",
+                                       (key, now - self.ttl)).fetchone()
+                if row is not None:
+                    chunks = json.loads(row[0])
+                    self._remember(key, row[1], chunks)
+                    self.disk_hits += 1
+                    return chunks
+
+            self.misses += 1
+            return None
+
+    def put(self, key, chunks):
+        """Store a complete answer"""
+        now = time.time()
+        chunks = list(chunks)
+        with self._lock:
+            self._remember(key, now, chunks)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, chunks, stored_at) VALUES (?, ?, ?)",
+                                 (key, json.dumps(chunks, ensure_ascii=False), now))
+                self._puts += 1
+                if self._puts % self.PURGE_EVERY == 0:
+                    self._db.execute("DELETE FROM responses WHERE stored_at <= ?", (now - self.ttl,))
+                self._db.commit()
+
+    def _remember(self, key, stored_at, chunks):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (stored_at, chunks)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """Hit and miss counters, e.g. for the /cache/stats endpoint"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else None,
+                "entries": len(self._entries),
+                "disk": self._db is not None,
+            }
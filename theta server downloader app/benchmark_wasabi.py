@@ -0,0 +1,256 @@
+"""Benchmark WasabiWorker scans, downloads and uploads against a local S3 stand-in.
+
+Starts a moto S3 server in a subprocess (or uses --endpoint, e.g. a MinIO instance),
+fills a bucket with a synthetic School/teachers/Teacher/classes/Class/recordings tree
+and times each stage of the worker with its own, throw-away state database:
+
+    python benchmark_wasabi.py --keys 10000 --min-size 64KB --max-size 1MB --download 500
+
+Reported per stage: wall time, objects or bytes per second, time spent in the
+database and the peak of Python memory allocated while the stage ran.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BUCKET = 'benchmark-recordings'
+
+def parse_size(text):
+    """'64KB', '1MB' or a plain number of bytes"""
+    text = text.strip().upper()
+    for suffix, factor in (('GB', 1024 ** 3), ('MB', 1024 ** 2), ('KB', 1024), ('B', 1)):
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * factor)
+    return int(text)
+
+def start_moto_server():
+    """Run moto's S3 server in a subprocess so it does not count towards our memory"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/moto-api/', timeout=1)
+            return process, url
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("moto server did not start; install it with: pip install 'moto[server]'")
+
+def recording_keys(count, schools, teachers, classes):
+    """Yield keys spread evenly over schools, teachers and classes"""
+    for index in range(count):
+        school = index % schools
+        teacher = (index // schools) % teachers
+        class_code = (index // (schools * teachers)) % classes
+        yield (f"School{school:03d}/teachers/teacher{teacher:03d}@example.com/classes/Class{class_code:03d}/"
+               f"recordings/{index:08d}.mp3")
+
+def seed_bucket(s3, keys, min_size, max_size, concurrency):
+    """Upload synthetic recordings; each body is unique so ETags differ"""
+    s3.create_bucket(Bucket=BUCKET)
+    payload = os.urandom(max_size)
+    rng = random.Random(42)
+    sizes = [rng.randint(min_size, max_size) for _ in keys]
+
+    def put(item):
+        key, size = item
+        body = key.encode()[:size] + payload[:max(0, size - len(key))]
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in pool.map(put, zip(keys, sizes)):
+            pass
+    return sum(sizes)
+
+class StageResult:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.db_seconds = 0.0
+        self.peak_memory = 0
+        self.extra = {}
+
+    def as_dict(self):
+        result = {
+            'stage': self.name,
+            'seconds': round(self.seconds, 3),
+            'items': self.items,
+            'items_per_second': round(self.items / self.seconds, 1) if self.seconds else None,
+            'bytes': self.bytes,
+            'mb_per_second': round(self.bytes / self.seconds / 1024 ** 2, 2) if self.seconds else None,
+            'db_seconds': round(self.db_seconds, 3),
+            'db_share': round(self.db_seconds / self.seconds, 3) if self.seconds else None,
+            'peak_memory_mb': round(self.peak_memory / 1024 ** 2, 1),
+        }
+        result.update(self.extra)
+        return result
+
+def histogram_sum(snapshot, name):
+    return sum(series['value']['sum'] for series in snapshot['histograms'].get(name, []))
+
+def counter_sum(snapshot, name):
+    return sum(series['value'] for series in snapshot['counters'].get(name, []))
+
+def run_stage(wm, name, worker, trace_memory):
+    """Run a worker synchronously and measure it"""
+    result = StageResult(name)
+    errors = []
+    worker.set_callbacks(lambda message: None, None, errors.append)
+    before = wm.metrics.snapshot()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    worker.start()
+    result.seconds = time.perf_counter() - started
+    if trace_memory:
+        result.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    after = wm.metrics.snapshot()
+    result.db_seconds = sum(histogram_sum(after, metric) - histogram_sum(before, metric)
+                            for metric in ('wasabi_db_query_seconds', 'wasabi_db_commit_seconds'))
+    result.extra['list_calls'] = counter_sum(after, 'wasabi_list_calls_total') - counter_sum(
+        before, 'wasabi_list_calls_total')
+    result.extra['retries'] = counter_sum(after, 'wasabi_retries_total') - counter_sum(before, 'wasabi_retries_total')
+    if errors:
+        result.extra['errors'] = errors
+    return result
+
+def print_results(results):
+    print(f"{'stage':<14}{'seconds':>10}{'items':>10}{'items/s':>11}{'MB/s':>9}{'db s':>9}{'db %':>7}{'peak MB':>9}")
+    for result in results:
+        row = result.as_dict()
+        items_per_second = row['items_per_second'] if row['items_per_second'] is not None else 0
+        mb_per_second = row['mb_per_second'] if row['mb_per_second'] is not None else 0
+        db_share = row['db_share'] * 100 if row['db_share'] is not None else 0
+        print(f"{row['stage']:<14}{row['seconds']:>10.2f}{row['items']:>10}{items_per_second:>11.1f}"
+              f"{mb_per_second:>9.2f}{row['db_seconds']:>9.2f}{db_share:>6.1f}%{row['peak_memory_mb']:>9.1f}")
+        if row.get('errors'):
+            print(f"    errors: {row['errors']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark WasabiWorker against a local S3 stand-in")
+    parser.add_argument('--keys', type=int, default=1000, help="recordings in the synthetic bucket (default: 1000)")
+    parser.add_argument('--schools', type=int, default=10)
+    parser.add_argument('--teachers', type=int, default=10, help="teachers per school (default: 10)")
+    parser.add_argument('--classes', type=int, default=5, help="classes per teacher (default: 5)")
+    parser.add_argument('--min-size', type=parse_size, default=parse_size('16KB'))
+    parser.add_argument('--max-size', type=parse_size, default=parse_size('64KB'))
+    parser.add_argument('--download', type=int, default=200,
+                        help="recordings to download, 0 to skip downloads (default: 200)")
+    parser.add_argument('--upload', type=int, default=100,
+                        help="summaries to upload for downloaded recordings (default: 100)")
+    parser.add_argument('--seed-concurrency', type=int, default=32)
+    parser.add_argument('--endpoint', help="use this S3-compatible endpoint instead of starting moto")
+    parser.add_argument('--workdir', help="keep files and the state database here instead of a temp folder")
+    parser.add_argument('--no-tracemalloc', action='store_true',
+                        help="skip peak memory tracking, which slows the stages down")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+    if args.max_size < args.min_size:
+        parser.error("--max-size must not be smaller than --min-size")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='wasabi-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    moto_process = None
+    if args.endpoint:
+        endpoint = args.endpoint
+    else:
+        moto_process, endpoint = start_moto_server()
+
+    try:
+        # The worker reads its endpoint, credentials and database when it is imported
+        os.environ['WASABI_ENDPOINT_URL'] = endpoint
+        os.environ.setdefault('WASABI_ACCESS_KEY', 'benchmark')
+        os.environ.setdefault('WASABI_SECRET_KEY', 'benchmark')
+        state_db = os.path.join(workdir, 'benchmark_state.db')
+        if os.path.exists(state_db):
+            os.remove(state_db)
+        os.environ['WASABI_DATABASE_URL'] = f'sqlite:///{state_db}'
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import wasabi_manager as wm
+
+        s3 = wm.client_registry.default_client()
+        keys = list(recording_keys(args.keys, args.schools, args.teachers, args.classes))
+        print(f"Seeding {len(keys)} recordings into {endpoint}...")
+        started = time.perf_counter()
+        total_bytes = seed_bucket(s3, keys, args.min_size, args.max_size, args.seed_concurrency)
+        seed = StageResult('seed')
+        seed.seconds = time.perf_counter() - started
+        seed.items = len(keys)
+        seed.bytes = total_bytes
+
+        trace_memory = not args.no_tracemalloc
+        results = [seed]
+
+        scanner = wm.WasabiWorker('scan', full_scan=True)
+        scan = run_stage(wm, 'full scan', scanner, trace_memory)
+        scan.items = scanner.found_count
+        results.append(scan)
+
+        # A second scan right away only lists what changed, which is nothing
+        rescanner = wm.WasabiWorker('scan')
+        rescan = run_stage(wm, 'delta scan', rescanner, trace_memory)
+        rescan.items = rescanner.found_count
+        results.append(rescan)
+
+        download_path = os.path.join(workdir, 'downloads')
+        upload_path = os.path.join(workdir, 'summaries')
+        for path in (download_path, upload_path):
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+
+        if args.download:
+            downloader = wm.WasabiWorker('download', destination_path=download_path)
+            downloader.download_limit = args.download
+            download = run_stage(wm, 'download', downloader, trace_memory)
+            downloaded = [name for name in os.listdir(download_path) if not name.endswith(('.part', '.json'))]
+            download.items = len(downloaded)
+            download.bytes = sum(os.path.getsize(os.path.join(download_path, name)) for name in downloaded)
+            results.append(download)
+
+            summaries = sorted(downloaded)[:args.upload]
+            for name in summaries:
+                with open(os.path.join(upload_path, os.path.splitext(name)[0] + '.pdf'), 'wb') as f:
+                    f.write(b'%PDF-1.4 benchmark summary\n' + os.urandom(4096))
+            if summaries:
+                uploader = wm.WasabiWorker('upload', source_path=upload_path)
+                upload = run_stage(wm, 'upload', uploader, trace_memory)
+                upload.items = int(counter_sum(wm.metrics.snapshot(), 'wasabi_files_uploaded_total'))
+                upload.bytes = int(counter_sum(wm.metrics.snapshot(), 'wasabi_bytes_uploaded_total'))
+                results.append(upload)
+
+        print()
+        print_results(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'keys': args.keys, 'min_size': args.min_size, 'max_size': args.max_size,
+                           'results': [result.as_dict() for result in results]}, f, indent=2)
+        return 0
+    finally:
+        if moto_process is not None:
+            moto_process.terminate()
+            moto_process.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# wasabi_manager opens its database when imported, so point it at a throw-away one first
+_STATE_DIR = tempfile.mkdtemp(prefix='wasabi-tests-')
+os.environ['WASABI_DATABASE_URL'] = f"sqlite:///{os.path.join(_STATE_DIR, 'state.db')}"
+os.environ['WASABI_COORD_DATABASE_URL'] = ''
+os.environ['WASABI_LOG_FILE'] = ''
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wasabi_manager as wm  # noqa: E402
+
+@pytest.fixture(autouse=True)
+def clean_queue():
+    """Start every test with an empty work queue and no node leases"""
+    session = wm.CoordSession()
+    try:
+        session.query(wm.WorkItem).delete()
+        session.query(wm.NodeLease).delete()
+        session.commit()
+    finally:
+        session.close()
+    yield
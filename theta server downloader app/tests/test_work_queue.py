@@ -0,0 +1,176 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import wasabi_manager as wm
+
+T0 = datetime(2026, 1, 5, 9, 0)
+
+def _queue(**kwargs):
+    kwargs.setdefault('policy', wm.PriorityPolicy(order='newest', fair=False, slas=''))
+    return wm.WorkQueue('download', **kwargs)
+
+def _row(item_id):
+    session = wm.CoordSession()
+    try:
+        return session.query(wm.WorkItem).filter(wm.WorkItem.id == item_id).one()
+    finally:
+        session.close()
+
+def _expire(item_id):
+    session = wm.CoordSession()
+    try:
+        session.query(wm.WorkItem).filter(wm.WorkItem.id == item_id).update(
+            {wm.WorkItem.lease_expires_at: datetime.utcnow() - timedelta(seconds=1)})
+        session.commit()
+    finally:
+        session.close()
+
+def test_leased_item_is_not_leased_again_until_its_lease_expires():
+    queue = _queue(lease=timedelta(minutes=5))
+    queue.enqueue([('alpha/SchoolA/r1.m4a', 10, 'etag', T0)])
+    [item] = queue.lease('node-a', 10)
+    assert queue.lease('node-b', 10) == []
+
+    _expire(item['id'])
+    [taken] = queue.lease('node-b', 10)
+    assert taken['id'] == item['id']
+    assert _row(item['id']).lease_owner == 'node-b'
+
+def test_renew_extends_only_the_owners_lease():
+    queue = _queue(lease=timedelta(minutes=5))
+    queue.enqueue([('alpha/SchoolA/r1.m4a', 10, 'etag', T0)])
+    [item] = queue.lease('node-a', 10)
+    _expire(item['id'])
+
+    queue.renew('node-b', [item['id']])
+    assert _row(item['id']).lease_expires_at < datetime.utcnow()
+    queue.renew('node-a', [item['id']])
+    assert _row(item['id']).lease_expires_at > datetime.utcnow() + timedelta(minutes=4)
+    assert queue.lease('node-b', 10) == []
+
+def test_release_with_owner_leaves_items_leased_by_another_node():
+    queue = _queue()
+    queue.enqueue([('alpha/SchoolA/r1.m4a', 10, 'etag', T0)])
+    [item] = queue.lease('node-a', 10)
+    queue.release([item['id']], owner='node-b')
+    assert _row(item['id']).state == 'in_progress'
+    queue.release([item['id']], owner='node-a')
+    assert _row(item['id']).state == 'pending'
+
+def test_complete_with_owner_leaves_items_leased_by_another_node():
+    queue = _queue()
+    queue.enqueue([('alpha/SchoolA/r1.m4a', 10, 'etag', T0)])
+    [item] = queue.lease('node-a', 10)
+    queue.complete([item['id']], owner='node-b')
+    assert _row(item['id']).state == 'in_progress'
+    queue.complete([item['id']], owner='node-a')
+    assert _row(item['id']).state == 'done'
+
+def test_failed_items_back_off_and_stop_after_max_attempts():
+    queue = _queue(max_attempts=2)
+    queue.enqueue([('alpha/SchoolA/r1.m4a', 10, 'etag', T0)])
+    [item] = queue.lease('node-a', 10)
+    assert queue.fail(item, 'timeout', owner='node-a') == 'pending'
+    assert queue.lease('node-a', 10) == []  # Waiting for its retry delay
+
+    session = wm.CoordSession()
+    session.query(wm.WorkItem).update({wm.WorkItem.available_at: None})
+    session.commit()
+    session.close()
+    [item] = queue.lease('node-a', 10)
+    assert queue.fail(item, 'timeout', owner='node-a') == 'failed'
+    assert _row(item['id']).last_error == 'timeout'
+
+def test_items_are_completed_only_after_their_records_are_committed(monkeypatch):
+    worker = wm.WasabiWorker('download')
+    worker.work_queue = _queue()
+    worker.work_queue.enqueue([('alpha/SchoolA/r1.m4a', 10, 'etag', T0)])
+    try:
+        [item] = worker.work_queue.lease(wm.NODE_ID, 10)
+        worker._completed_items.append(item['id'])
+
+        def broken_commit(rows):
+            raise wm.DatabaseError('COMMIT', {}, Exception('disk I/O error'))
+
+        monkeypatch.setattr(worker, '_commit_processed_rows', broken_commit)
+        with pytest.raises(wm.DatabaseError):
+            worker._commit_processed()
+        assert _row(item['id']).state == 'pending'
+
+        monkeypatch.undo()
+        [item] = worker.work_queue.lease(wm.NODE_ID, 10)
+        worker._completed_items.append(item['id'])
+        worker._commit_processed()
+        assert _row(item['id']).state == 'done'
+    finally:
+        worker.session.close()
+
+def test_schedule_puts_deadlines_first_then_takes_turns_between_schools():
+    queue = _queue(policy=wm.PriorityPolicy(order='newest', fair=True, slas='SchoolC/=1h'))
+    queue.enqueue([
+        ('alpha/SchoolA/a1.m4a', 10, 'a1', T0 + timedelta(minutes=1)),
+        ('alpha/SchoolA/a2.m4a', 10, 'a2', T0 + timedelta(minutes=2)),
+        ('alpha/SchoolA/a3.m4a', 10, 'a3', T0 + timedelta(minutes=3)),
+        ('alpha/SchoolB/b1.m4a', 10, 'b1', T0 + timedelta(minutes=1)),
+        ('alpha/SchoolC/c1.m4a', 10, 'c1', T0),
+    ])
+    paths = [item['path'] for item in queue.lease('node-a', 10)]
+
+    assert paths[0] == 'alpha/SchoolC/c1.m4a'
+    # One recording of each school before a school's second one, newest first within a school
+    assert set(paths[1:3]) == {'alpha/SchoolA/a3.m4a', 'alpha/SchoolB/b1.m4a'}
+    assert paths[3:] == ['alpha/SchoolA/a2.m4a', 'alpha/SchoolA/a1.m4a']
+
+def test_schedule_without_fairness_follows_the_queue_order():
+    queue = _queue(policy=wm.PriorityPolicy(order='oldest', fair=False, slas=''))
+    queue.enqueue([
+        ('alpha/SchoolA/a2.m4a', 10, 'a2', T0 + timedelta(minutes=2)),
+        ('alpha/SchoolB/b1.m4a', 10, 'b1', T0 + timedelta(minutes=1)),
+        ('alpha/SchoolA/a3.m4a', 10, 'a3', None),
+    ])
+    paths = [item['path'] for item in queue.lease('node-a', 10)]
+    assert paths == ['alpha/SchoolB/b1.m4a', 'alpha/SchoolA/a2.m4a', 'alpha/SchoolA/a3.m4a']
+
+def test_expired_leases_are_taken_before_new_items():
+    queue = _queue()
+    queue.enqueue([('alpha/SchoolA/old.m4a', 10, 'old', T0)])
+    [stuck] = queue.lease('node-a', 10)
+    _expire(stuck['id'])
+    queue.enqueue([('alpha/SchoolA/new.m4a', 10, 'new', T0 + timedelta(days=1))])
+    assert [item['id'] for item in queue.lease('node-b', 1)] == [stuck['id']]
+
+def test_node_lease_is_exclusive_until_it_expires():
+    leases = wm.NodeLeases(duration=timedelta(minutes=5))
+    assert leases.acquire('scan:', 'node-a')
+    assert not leases.acquire('scan:', 'node-b')
+    assert not leases.renew('scan:', 'node-b')
+    assert leases.holder('scan:') == 'node-a'
+    assert leases.active('scan:')
+
+    session = wm.CoordSession()
+    session.query(wm.NodeLease).update({wm.NodeLease.expires_at: datetime.utcnow() - timedelta(seconds=1)})
+    session.commit()
+    session.close()
+    assert not leases.active('scan:')
+    assert leases.acquire('scan:', 'node-b')
+    assert not leases.renew('scan:', 'node-a')
+
+    leases.release('scan:', 'node-b')
+    assert leases.holder('scan:') is None
+
+def test_reconcile_drops_pending_items_of_deleted_recordings():
+    queue = _queue()
+    queue.enqueue([('deleted/SchoolA/kept.m4a', 10, 'kept', T0), ('deleted/SchoolA/gone.m4a', 10, 'gone', T0)])
+    session = wm.Session()
+    try:
+        for key in ('SchoolA/kept.m4a', 'SchoolA/gone.m4a'):
+            session.add(wm.ListingManifest(bucket='deleted', key=key, etag='x', size=10, last_modified=T0))
+        session.commit()
+
+        diff = wm.ManifestDiff(session, 'deleted', 'SchoolA/', queue)
+        diff.add_page([{'Key': 'SchoolA/kept.m4a', 'ETag': '"x"', 'Size': 10}])
+        assert diff.finish({}, datetime.utcnow()) == 1
+    finally:
+        session.close()
+    assert [item['path'] for item in queue.lease('node-a', 10)] == ['deleted/SchoolA/kept.m4a']
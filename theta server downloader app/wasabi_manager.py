@@ -1,304 +1,2857 @@
 import sys
 import os
-from datetime import datetime
+import argparse
+import cProfile
+import hashlib
+import json
+import logging
+import queue
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import (ClientError, ConnectionError as BotoConnectionError, HTTPClientError,
+                                 ConnectTimeoutError, ReadTimeoutError)
 from dotenv import load_dotenv
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-                           QPushButton, QFileDialog, QTextEdit, QLabel, 
+                           QPushButton, QFileDialog, QPlainTextEdit, QLabel, 
                            QProgressBar, QMessageBox, QSpinBox, QListWidgetItem, QLineEdit)
-from PySide6.QtCore import Qt, QThread, Signal, QTimer
-from sqlalchemy import create_engine, Column, String, DateTime, Integer
+from PySide6.QtCore import Qt, QThread, Signal, QTimer, QObject, QFileSystemWatcher, QCoreApplication
+from sqlalchemy import (create_engine, event, inspect, text, Column, String, DateTime, Integer, Float, Index, and_,
+                        or_, exists, func)
+from sqlalchemy.exc import DatabaseError, IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 # Load environment variables
 load_dotenv()
 
+def _log_level(variable, default):
+    """Numeric level named by an environment variable; unknown names fall back to default with a warning"""
+    name = os.getenv(variable, logging.getLevelName(default)).strip().upper()
+    level = logging.getLevelName(name)
+    if not isinstance(level, int):
+        print(f"Warning: unknown log level {name!r} in {variable}, using {logging.getLevelName(default)}",
+              file=sys.stderr)
+        return default
+    return level
+
+# Logging: everything goes to a rotating file, INFO and above also to the window or console
+LOG_FILE = os.getenv('WASABI_LOG_FILE', 'wasabi_manager.log')
+LOG_FILE_LEVEL = _log_level('WASABI_LOG_LEVEL', logging.DEBUG)
+LOG_MAX_BYTES = int(os.getenv('WASABI_LOG_MAX_MB', '10')) * 1024 * 1024
+LOG_BACKUPS = int(os.getenv('WASABI_LOG_BACKUPS', '5'))
+UI_LOG_LEVEL = _log_level('WASABI_UI_LOG_LEVEL', logging.INFO)
+UI_LOG_LINES = int(os.getenv('WASABI_UI_LOG_LINES', '5000'))  # Lines kept in the log view
+
+logger = logging.getLogger('wasabi_manager')
+logger.addHandler(logging.NullHandler())
+
+def setup_file_logging():
+    """Send the full log to a size-rotated file (WASABI_LOG_FILE, empty to disable)"""
+    logger.setLevel(logging.DEBUG)
+    if not LOG_FILE or any(isinstance(handler, RotatingFileHandler) for handler in logger.handlers):
+        return
+    handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    handler.setLevel(LOG_FILE_LEVEL)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s [%(threadName)s] %(message)s'))
+    logger.addHandler(handler)
+
+# Metrics exporters and profiling are off unless configured
+METRICS_PORT = int(os.getenv('WASABI_METRICS_PORT', '0'))
+STATS_FILE = os.getenv('WASABI_STATS_FILE')
+STATS_INTERVAL = float(os.getenv('WASABI_STATS_INTERVAL', '30'))  # seconds
+PROFILE_DIR = os.getenv('WASABI_PROFILE_DIR')
+
+# Histogram bucket bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms, exported as Prometheus text or JSON.
+
+    Metric names follow Prometheus conventions; labels are passed as keyword
+    arguments, e.g. metrics.inc('wasabi_retries_total', kind='throttle').
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {labels: value}
+        self._gauges = {}
+        self._histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._histograms.setdefault(name, {}).get(key)
+            if values is None:
+                values = self._histograms[name][key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the with-block in seconds, even when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """All metrics as a JSON-serialisable dict"""
+        def series(values, convert):
+            return [{'labels': dict(key), 'value': convert(value)} for key, value in values.items()]
+        with self._lock:
+            return {
+                'counters': {name: series(values, lambda v: v) for name, values in self._counters.items()},
+                'gauges': {name: series(values, lambda v: v) for name, values in self._gauges.items()},
+                'histograms': {name: series(values, lambda v: {
+                    'buckets': dict(zip(map(str, LATENCY_BUCKETS), v[:-2])), 'sum': v[-2], 'count': v[-1]})
+                    for name, values in self._histograms.items()},
+            }
+
+    def prometheus_text(self):
+        def label_text(key, extra=()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters), ('gauge', self._gauges)):
+                for name, values in sorted(metrics.items()):
+                    lines.append(f'# TYPE {name} {kind}')
+                    lines.extend(f'{name}{label_text(key)} {value}' for key, value in values.items())
+            for name, values in sorted(self._histograms.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for key, counts in values.items():
+                    for bound, count in zip(LATENCY_BUCKETS, counts):
+                        lines.append(f'{name}_bucket{label_text(key, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{label_text(key, [("le", "+Inf")])} {counts[-1]}')
+                    lines.append(f'{name}_sum{label_text(key)} {counts[-2]}')
+                    lines.append(f'{name}_count{label_text(key)} {counts[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = metrics.prometheus_text().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(metrics.snapshot(), default=str).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep scrapes out of the console
+
+def start_metrics_exporters(log=print):
+    """Start the metrics endpoint and stats file writer that are configured; returns a stop function"""
+    stoppers = []
+    if METRICS_PORT:
+        server = ThreadingHTTPServer(('127.0.0.1', METRICS_PORT), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='wasabi-metrics', daemon=True).start()
+        stoppers.append(server.shutdown)
+        log(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics (JSON at /metrics.json)")
+
+    if STATS_FILE:
+        stop_event = threading.Event()
+
+        def write_stats():
+            while True:
+                temp_path = STATS_FILE + '.tmp'
+                try:
+                    with open(temp_path, 'w') as f:
+                        json.dump(metrics.snapshot(), f, default=str, indent=1)
+                    os.replace(temp_path, STATS_FILE)
+                except OSError as e:
+                    log(f"Failed to write stats file: {str(e)}")
+                if stop_event.wait(STATS_INTERVAL):
+                    return
+
+        writer = threading.Thread(target=write_stats, name='wasabi-stats', daemon=True)
+        writer.start()
+        stoppers.append(lambda: (stop_event.set(), writer.join()))
+
+    def stop():
+        for stopper in stoppers:
+            stopper()
+    return stop
+
+@contextmanager
+def profiled(stage):
+    """Run the with-block under cProfile when WASABI_PROFILE_DIR is set.
+
+    Profiles cover the thread that runs the stage; time spent waiting on pool
+    threads shows up as waits, and their work in the wasabi_* latency histograms.
+    """
+    if not PROFILE_DIR:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(
+            PROFILE_DIR, f"{stage}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}.prof"))
+
 # Database setup
 Base = declarative_base()
 
-class ProcessedFile(Base):
-    __tablename__ = 'processed_files'
-    id = Column(Integer, primary_key=True)
-    file_path = Column(String)
-    operation = Column(String)  # 'download' or 'upload'
-    processed_at = Column(DateTime, default=datetime.utcnow)
-    local_timestamp = Column(String, nullable=True)  # Store the timestamp used in local filename
+class ProcessedFile(Base):
+    __tablename__ = 'processed_files'
+    id = Column(Integer, primary_key=True)
+    file_path = Column(String)
+    operation = Column(String)  # 'download' or 'upload'
+    processed_at = Column(DateTime, default=datetime.utcnow)
+    local_timestamp = Column(String, nullable=True)  # Store the timestamp used in local filename
+    file_id = Column(String, nullable=True)  # Recording ID (last '_' part of the filename) for downloads
+    content_key = Column(String, nullable=True)  # '<etag>:<size>' of a downloaded recording
+    content_hash = Column(String, nullable=True)  # SHA-256 of the local file, for multipart ETags
+    __table_args__ = (
+        Index('ix_processed_files_path_operation', 'file_path', 'operation', unique=True),
+        Index('ix_processed_files_file_id', 'file_id'),
+        Index('ix_processed_files_content_key', 'content_key'),
+        Index('ix_processed_files_content_hash', 'content_hash'),
+    )
+
+def _file_id_for(file_path):
+    """Recording ID used to match summaries: the last '_' part of the file name without extension"""
+    return os.path.splitext(file_path.rsplit('/', 1)[-1])[0].split('_')[-1]
+
+def summary_path_for(path, summary_folders=None):
+    """Convert a recording path to its corresponding summary path.
+
+    summary_folders maps recordings folders to the summaries folder a scan found
+    next to them (see summary_folders_for); other recordings get a 'summaries' folder.
+    """
+    # Split the path into parts
+    path_parts = path.split('/')
+
+    # Replace the last folder with 'summaries'
+    if len(path_parts) > 1:
+        path_parts[-2] = 'summaries'
+    else:
+        path_parts.insert(-1, 'summaries')
+
+    # Add _summary to the filename and change extension to .pdf
+    if '.' in path_parts[-1]:
+        base_name = os.path.splitext(path_parts[-1])[0]
+        path_parts[-1] = f"{base_name}_summary.pdf"
+
+    folder = path.rsplit('/', 1)[0]
+    if summary_folders and folder in summary_folders:
+        path_parts = summary_folders[folder].split('/') + path_parts[-1:]
+
+    return '/'.join(path_parts)
+
+def _content_key(etag, size):
+    """Identify a recording's content by ETag and size; None when either is unknown"""
+    etag = (etag or '').strip('"').lower()
+    if not etag or size is None:
+        return None
+    return f"{etag}:{size}"
+
+def _is_md5_etag(etag):
+    """Single-part uploads have the MD5 of the content as ETag; multipart ETags end in '-<parts>'"""
+    return len(etag) == 32 and '-' not in etag
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MB), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class ListingManifest(Base):
+    """Recordings seen by the last listing of each prefix, used to find new or changed objects"""
+    __tablename__ = 'listing_manifest'
+    id = Column(Integer, primary_key=True)
+    bucket = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    etag = Column(String)
+    size = Column(Integer)
+    last_modified = Column(DateTime)
+    __table_args__ = (Index('ix_listing_manifest_bucket_key', 'bucket', 'key', unique=True),)
+
+class ScanState(Base):
+    """Listing bookkeeping per bucket/prefix; the start path's row records the last full reconcile"""
+    __tablename__ = 'scan_state'
+    id = Column(Integer, primary_key=True)
+    bucket = Column(String, nullable=False)
+    prefix = Column(String, nullable=False)
+    high_water_mark = Column(DateTime, nullable=True)  # Newest LastModified seen below the prefix
+    object_count = Column(Integer, default=0)
+    last_listed_at = Column(DateTime, nullable=True)
+    last_changed_at = Column(DateTime, nullable=True)
+    last_full_scan_at = Column(DateTime, nullable=True)
+    __table_args__ = (Index('ix_scan_state_bucket_prefix', 'bucket', 'prefix', unique=True),)
+
+class SummaryFolder(Base):
+    """Summaries folder a scan found next to a recordings folder, so summaries keep its spelling.
+
+    Kept in the coordination database, so nodes that did not scan upload to the same folder.
+    """
+    __tablename__ = 'summary_folders'
+    id = Column(Integer, primary_key=True)
+    bucket = Column(String, nullable=False)
+    recordings_folder = Column(String, nullable=False)  # bucket/.../Recordings
+    summaries_folder = Column(String, nullable=False)  # bucket/.../Summary
+    __table_args__ = (Index('ix_summary_folders_recordings_folder', 'recordings_folder', unique=True),)
+
+class LocalSeenFile(Base):
+    """Local summary files already handed to an upload, so a restart does not upload them again"""
+    __tablename__ = 'local_seen_files'
+    id = Column(Integer, primary_key=True)
+    directory = Column(String, nullable=False)
+    file_name = Column(String, nullable=False)
+    size = Column(Integer)
+    modified_at = Column(Float)  # st_mtime when the file was handed over
+    seen_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index('ix_local_seen_files_directory_name', 'directory', 'file_name', unique=True),)
+
+class WorkItem(Base):
+    """Persistent work queue entry, e.g. a recording waiting to be downloaded.
+
+    state is 'pending', 'in_progress' (leased by lease_owner until lease_expires_at),
+    'done' or 'failed' (after too many attempts).
+    """
+    __tablename__ = 'work_queue'
+    id = Column(Integer, primary_key=True)
+    operation = Column(String, nullable=False)
+    path = Column(String, nullable=False)  # bucket/key
+    size = Column(Integer)
+    etag = Column(String)
+    last_modified = Column(DateTime)
+    state = Column(String, nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime, nullable=True)  # Retry backoff: not leased before this time
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+    enqueued_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    group_key = Column(String, nullable=True)  # bucket/school, for round-robin fairness
+    deadline = Column(DateTime, nullable=True)  # From the SLA of the first matching WASABI_QUEUE_SLAS prefix
+    __table_args__ = (
+        Index('ix_work_queue_operation_path', 'operation', 'path', unique=True),
+        Index('ix_work_queue_operation_state', 'operation', 'state', 'id'),
+        Index('ix_work_queue_schedule', 'operation', 'state', 'group_key', 'last_modified'),
+        Index('ix_work_queue_deadline', 'operation', 'state', 'deadline'),
+    )
+
+class NodeLease(Base):
+    """A named resource claimed by one node until expires_at, e.g. the scan of a start path"""
+    __tablename__ = 'node_leases'
+    id = Column(Integer, primary_key=True)
+    resource = Column(String, nullable=False)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    __table_args__ = (Index('ix_node_leases_resource', 'resource', unique=True),)
+
+class TranscodedFile(Base):
+    """A downloaded recording converted to the speech profile, mapped back to its Wasabi path"""
+    __tablename__ = 'transcoded_files'
+    id = Column(Integer, primary_key=True)
+    source_file = Column(String, nullable=False)  # Downloaded file name in the download folder
+    output_file = Column(String, nullable=True)  # Transcoded file name; None when transcoding failed
+    file_path = Column(String, nullable=True)  # Original Wasabi path (bucket/key)
+    source_size = Column(Integer)
+    output_size = Column(Integer)
+    error = Column(String, nullable=True)
+    transcoded_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index('ix_transcoded_files_source_file', 'source_file', unique=True),)
+
+def _migrate_processed_files(engine):
+    """Bring processed_files tables created by older versions up to the current schema"""
+    table_inspector = inspect(engine)
+    if not table_inspector.has_table('processed_files'):
+        return
+    index_names = {index['name'] for index in table_inspector.get_indexes('processed_files')}
+    column_names = {column['name'] for column in table_inspector.get_columns('processed_files')}
+
+    with engine.begin() as connection:
+        if 'ix_processed_files_path_operation' not in index_names:
+            # Older versions could record the same file twice; keep the first row of each pair
+            connection.exec_driver_sql(
+                "DELETE FROM processed_files WHERE id NOT IN "
+                "(SELECT MIN(id) FROM processed_files GROUP BY file_path, operation)")
+            connection.exec_driver_sql(
+                "CREATE UNIQUE INDEX ix_processed_files_path_operation "
+                "ON processed_files (file_path, operation)")
+
+        if 'file_id' not in column_names:
+            connection.exec_driver_sql("ALTER TABLE processed_files ADD COLUMN file_id VARCHAR")
+            rows = connection.exec_driver_sql(
+                "SELECT id, file_path FROM processed_files WHERE operation = 'download'").fetchall()
+            for row_id, file_path in rows:
+                if file_path:
+                    connection.exec_driver_sql(
+                        "UPDATE processed_files SET file_id = ? WHERE id = ?", (_file_id_for(file_path), row_id))
+        if 'ix_processed_files_file_id' not in index_names:
+            connection.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS ix_processed_files_file_id ON processed_files (file_id)")
+
+        if 'content_key' not in column_names:
+            connection.exec_driver_sql("ALTER TABLE processed_files ADD COLUMN content_key VARCHAR")
+            connection.exec_driver_sql("ALTER TABLE processed_files ADD COLUMN content_hash VARCHAR")
+            if table_inspector.has_table('listing_manifest'):
+                # Earlier downloads take their ETag and size from the scan manifest
+                connection.exec_driver_sql(
+                    "UPDATE processed_files SET content_key = ("
+                    "SELECT lower(m.etag) || ':' || m.size FROM listing_manifest m "
+                    "WHERE m.bucket = substr(processed_files.file_path, 1, instr(processed_files.file_path, '/') - 1) "
+                    "AND m.key = substr(processed_files.file_path, instr(processed_files.file_path, '/') + 1) "
+                    "AND m.etag != '' AND m.size IS NOT NULL) "
+                    "WHERE operation = 'download'")
+        for column in ('content_key', 'content_hash'):
+            connection.exec_driver_sql(
+                f"CREATE INDEX IF NOT EXISTS ix_processed_files_{column} ON processed_files ({column})")
+
+# Order in which queued work is picked up: recordings with an SLA first, earliest deadline
+# first; then the rest, newest (or oldest) LastModified first, taking turns between schools
+QUEUE_ORDER = os.getenv('WASABI_QUEUE_ORDER', 'newest').lower()  # 'newest' or 'oldest'
+QUEUE_FAIRNESS = os.getenv('WASABI_QUEUE_FAIRNESS', '1') == '1'
+QUEUE_SLAS = os.getenv('WASABI_QUEUE_SLAS', '')  # e.g. 'SchoolA/=2h,alpha/SchoolB/teachers/=30m'
+
+def _parse_duration(text):
+    """'90s', '30m', '2h' or '1d' as a timedelta; a plain number is minutes"""
+    text = text.strip().lower()
+    units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+    if text and text[-1] in units:
+        return timedelta(**{units[text[-1]]: float(text[:-1])})
+    return timedelta(minutes=float(text))
+
+class PriorityPolicy:
+    """Decides which pending recordings and summaries go first.
+
+    Paths matching an SLA prefix (either 'bucket/key...' or just 'key...') get a deadline
+    of LastModified plus the SLA and are handled earliest deadline first. Everything else
+    is taken newest (or oldest) first, in turns between schools when fairness is on, so a
+    large backlog in one school does not hold up today's lectures elsewhere.
+    """
+    def __init__(self, order=QUEUE_ORDER, fair=QUEUE_FAIRNESS, slas=QUEUE_SLAS):
+        if order not in ('newest', 'oldest'):
+            raise ValueError(f"WASABI_QUEUE_ORDER must be 'newest' or 'oldest', not {order!r}")
+        self.newest_first = order == 'newest'
+        self.fair = fair
+        self.slas = []
+        for entry in filter(None, (entry.strip() for entry in slas.split(','))):
+            prefix, _, duration = entry.rpartition('=')
+            self.slas.append((prefix.strip(), _parse_duration(duration)))
+
+    def group(self, path):
+        """Fairness group of a bucket/key path: the bucket and top-level (school) prefix"""
+        return '/'.join(path.split('/', 2)[:2])
+
+    def deadline(self, path, last_modified):
+        if last_modified is None:
+            return None
+        key = path.split('/', 1)[-1]
+        for prefix, sla in self.slas:
+            if path.startswith(prefix) or key.startswith(prefix):
+                return last_modified + sla
+        return None
+
+    def order(self, items, path, last_modified):
+        """Sort items in memory; path and last_modified are functions returning an item's values"""
+        def time_key(item):
+            value = last_modified(item)
+            if value is None:
+                return (1, 0)
+            timestamp = value.timestamp() if value.tzinfo else value.replace(tzinfo=timezone.utc).timestamp()
+            return (0, -timestamp if self.newest_first else timestamp)
+
+        due, groups = [], {}
+        for item in items:
+            deadline = self.deadline(path(item), last_modified(item))
+            if deadline is not None:
+                due.append((deadline, item))
+            else:
+                groups.setdefault(self.group(path(item)) if self.fair else '', []).append(item)
+        ordered = [item for _, item in sorted(due, key=lambda entry: entry[0])]
+        # Take one item from each group in turn
+        queues = [deque(sorted(group, key=time_key)) for group in groups.values()]
+        while queues:
+            for group in queues:
+                ordered.append(group.popleft())
+            queues = [group for group in queues if group]
+        return ordered
+
+priority_policy = PriorityPolicy()
+
+def _migrate_work_queue(db_engine):
+    """Add the scheduling columns to work_queue tables created by older versions"""
+    table_inspector = inspect(db_engine)
+    if not table_inspector.has_table('work_queue'):
+        return
+    column_names = {column['name'] for column in table_inspector.get_columns('work_queue')}
+    with db_engine.begin() as connection:
+        if 'group_key' not in column_names:
+            connection.execute(text("ALTER TABLE work_queue ADD COLUMN group_key VARCHAR"))
+            connection.execute(text("ALTER TABLE work_queue ADD COLUMN deadline TIMESTAMP"))
+            rows = connection.execute(text(
+                "SELECT id, path, last_modified FROM work_queue WHERE state IN ('pending', 'in_progress')")).fetchall()
+            updates = []
+            for row_id, path, last_modified in rows:
+                if isinstance(last_modified, str):
+                    last_modified = datetime.fromisoformat(last_modified)
+                updates.append({'id': row_id, 'group_key': priority_policy.group(path),
+                                'deadline': priority_policy.deadline(path, last_modified)})
+            if updates:
+                connection.execute(text(
+                    "UPDATE work_queue SET group_key = :group_key, deadline = :deadline WHERE id = :id"), updates)
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_work_queue_schedule "
+                                "ON work_queue (operation, state, group_key, last_modified)"))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_work_queue_deadline "
+                                "ON work_queue (operation, state, deadline)"))
+
+def _enable_wal(dbapi_connection, _connection_record):
+    # Scan, download and upload stages use the database from different threads at once;
+    # WAL lets them read while another stage commits
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    metrics.observe('wasabi_db_query_seconds', time.perf_counter() - started,
+                    statement=statement.split(None, 1)[0].upper())
+
+def _create_engine(url):
+    if url.startswith('sqlite'):
+        db_engine = create_engine(url, connect_args={'timeout': 30})
+        event.listen(db_engine, 'connect', _enable_wal)
+    else:
+        db_engine = create_engine(url, pool_pre_ping=True)
+    event.listen(db_engine, 'before_cursor_execute', _start_query_timer)
+    event.listen(db_engine, 'after_cursor_execute', _stop_query_timer)
+    return db_engine
+
+# Create database engine and tables
+DATABASE_URL = os.getenv('WASABI_DATABASE_URL', 'sqlite:///processed_files.db')
+engine = _create_engine(DATABASE_URL)
+
+_migrate_processed_files(engine)
+_migrate_work_queue(engine)
+# Only create tables if they don't exist
+Base.metadata.create_all(engine)
+# Without autoflush, rows added for a batched commit do not hold the write lock until that commit
+Session = sessionmaker(bind=engine, autoflush=False)
+
+# Several machines can share the archive: with a coordination database (e.g. PostgreSQL, or a
+# SQLite file that every instance on one machine can reach) the download queue and node leases
+# live there instead of in the local database, so each recording is downloaded by one node only
+COORD_DATABASE_URL = os.getenv('WASABI_COORD_DATABASE_URL')
+COORDINATED = bool(COORD_DATABASE_URL)
+if COORDINATED:
+    coord_engine = _create_engine(COORD_DATABASE_URL)
+    for attempt in range(3):
+        try:
+            _migrate_work_queue(coord_engine)
+            Base.metadata.create_all(coord_engine, tables=[WorkItem.__table__, NodeLease.__table__,
+                                                                 SummaryFolder.__table__])
+            break
+        except DatabaseError:
+            # Another node is creating the tables at the same moment
+            if attempt == 2:
+                raise
+            time.sleep(1)
+    CoordSession = sessionmaker(bind=coord_engine, autoflush=False)
+else:
+    coord_engine = engine
+    CoordSession = Session
+
+# ProcessedFile rows are committed in batches of this size
+PROCESSED_COMMIT_BATCH = 50
+# Paths per IN (...) query, kept below SQLite's bound-parameter limit
+PROCESSED_LOOKUP_CHUNK = 500
+
+def processed_paths(session, paths, operation):
+    """Return the subset of paths that already have a ProcessedFile row for operation"""
+    paths = list(set(paths))
+    found = set()
+    for start in range(0, len(paths), PROCESSED_LOOKUP_CHUNK):
+        chunk = paths[start:start + PROCESSED_LOOKUP_CHUNK]
+        found.update(row.file_path for row in session.query(ProcessedFile.file_path).filter(
+            ProcessedFile.operation == operation,
+            ProcessedFile.file_path.in_(chunk)))
+    return found
+
+def summary_folders_for(paths):
+    """Map the recordings folders of paths to the summaries folder found next to them by a scan"""
+    folders = list({path.rsplit('/', 1)[0] for path in paths if '/' in path})
+    found = {}
+    session = CoordSession()
+    try:
+        for start in range(0, len(folders), PROCESSED_LOOKUP_CHUNK):
+            chunk = folders[start:start + PROCESSED_LOOKUP_CHUNK]
+            for row in session.query(SummaryFolder.recordings_folder, SummaryFolder.summaries_folder).filter(
+                    SummaryFolder.recordings_folder.in_(chunk)):
+                found[row.recordings_folder] = row.summaries_folder
+    finally:
+        session.close()
+    return found
+
+def downloads_by_file_id(session, file_ids):
+    """Map each recording ID to its downloaded rows, oldest first"""
+    file_ids = list(set(file_ids))
+    matches = {}
+    for start in range(0, len(file_ids), PROCESSED_LOOKUP_CHUNK):
+        chunk = file_ids[start:start + PROCESSED_LOOKUP_CHUNK]
+        rows = session.query(ProcessedFile.file_id, ProcessedFile.file_path, ProcessedFile.local_timestamp,
+                             ProcessedFile.content_key, ProcessedFile.content_hash).filter(
+            ProcessedFile.operation == 'download',
+            ProcessedFile.file_id.in_(chunk)).order_by(ProcessedFile.id)
+        for row in rows:
+            matches.setdefault(row.file_id, []).append(row)
+    return matches
+
+def downloads_by_content(session, content_keys=(), content_hashes=()):
+    """Map content keys and local hashes to the downloaded rows that have them, oldest first.
+
+    Returns (rows by content key, rows by content hash).
+    """
+    by_key, by_hash = {}, {}
+    for column, values, matches in ((ProcessedFile.content_key, content_keys, by_key),
+                                    (ProcessedFile.content_hash, content_hashes, by_hash)):
+        values = list({value for value in values if value})
+        for start in range(0, len(values), PROCESSED_LOOKUP_CHUNK):
+            chunk = values[start:start + PROCESSED_LOOKUP_CHUNK]
+            rows = session.query(ProcessedFile.file_path, ProcessedFile.local_timestamp,
+                                 ProcessedFile.content_key, ProcessedFile.content_hash).filter(
+                ProcessedFile.operation == 'download',
+                column.in_(chunk)).order_by(ProcessedFile.id)
+            for row in rows:
+                matches.setdefault(getattr(row, column.key), []).append(row)
+    return by_key, by_hash
+
+# Work queue leases expire unless renewed, so items held by a crashed instance are picked up again
+WORK_QUEUE_LEASE = timedelta(seconds=int(os.getenv('WASABI_QUEUE_LEASE_SECONDS', '120')))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv('WASABI_QUEUE_MAX_ATTEMPTS', '10'))
+NODE_ID = os.getenv('WASABI_NODE_ID') or f"{socket.gethostname()}:{os.getpid()}"
+
+class WorkQueue:
+    """Database-backed queue of work items for one operation, shared by threads, restarts and nodes.
+
+    The scan enqueues recordings as it lists them and the download stage leases them
+    in batches, in the order chosen by the PriorityPolicy. A lease expires after
+    WORK_QUEUE_LEASE unless renewed, so items left in progress by a crash are picked up
+    again by the next run or another node. Every method uses a short session of its own,
+    so the queue can be used from any thread.
+    """
+    GROUP_REFRESH_INTERVAL = 10  # seconds between lookups of the schools that have pending work
+
+    def __init__(self, operation='download', lease=WORK_QUEUE_LEASE, max_attempts=WORK_QUEUE_MAX_ATTEMPTS,
+                 policy=None):
+        self.operation = operation
+        self.lease_duration = lease
+        self.max_attempts = max_attempts
+        self.policy = policy or priority_policy
+        self._groups = deque()  # Schools with pending work, in round-robin order
+        self._groups_loaded_at = None
+
+    def _available(self, now):
+        return or_(
+            and_(WorkItem.state == 'pending', or_(WorkItem.available_at.is_(None), WorkItem.available_at <= now)),
+            and_(WorkItem.state == 'in_progress', WorkItem.lease_expires_at < now))
+
+    def enqueue(self, objects):
+        """Queue (path, size, etag, last_modified) tuples; returns how many became pending.
+
+        Known items are only queued again when their size or ETag changed.
+        """
+        objects = list({obj[0]: obj for obj in objects}.values())
+        queued = 0
+        session = CoordSession()
+        try:
+            for start in range(0, len(objects), PROCESSED_LOOKUP_CHUNK):
+                chunk = objects[start:start + PROCESSED_LOOKUP_CHUNK]
+                try:
+                    queued += self._enqueue_chunk(session, chunk)
+                except IntegrityError:
+                    # Another node queued some of these meanwhile; look again
+                    session.rollback()
+                    queued += self._enqueue_chunk(session, chunk)
+        finally:
+            session.close()
+        return queued
+
+    def _enqueue_chunk(self, session, chunk):
+        queued = 0
+        now = datetime.utcnow()
+        existing = {row.path: row for row in session.query(WorkItem).filter(
+            WorkItem.operation == self.operation,
+            WorkItem.path.in_([obj[0] for obj in chunk]))}
+        for path, size, etag, last_modified in chunk:
+            row = existing.get(path)
+            deadline = self.policy.deadline(path, last_modified)
+            if row is None:
+                session.add(WorkItem(operation=self.operation, path=path, size=size, etag=etag,
+                                     last_modified=last_modified, state='pending',
+                                     attempts=0, enqueued_at=now, updated_at=now,
+                                     group_key=self.policy.group(path), deadline=deadline))
+                queued += 1
+            elif (row.etag, row.size) != (etag, size) and row.state != 'in_progress':
+                row.size, row.etag, row.last_modified = size, etag, last_modified
+                row.state, row.attempts, row.available_at, row.last_error = 'pending', 0, None, None
+                row.group_key, row.deadline = self.policy.group(path), deadline
+                row.updated_at = now
+                queued += 1
+        session.commit()
+        return queued
+
+    def _pending(self, session, now):
+        """Available pending items without an SLA"""
+        return session.query(WorkItem.id).filter(
+            WorkItem.operation == self.operation, WorkItem.state == 'pending', WorkItem.deadline.is_(None),
+            or_(WorkItem.available_at.is_(None), WorkItem.available_at <= now))
+
+    def _by_time(self):
+        """Newest or oldest LastModified first; items without one last"""
+        last_modified = WorkItem.last_modified.desc() if self.policy.newest_first else WorkItem.last_modified
+        return WorkItem.last_modified.is_(None), last_modified, WorkItem.id
+
+    def _refresh_groups(self, session):
+        groups = {group for (group,) in session.query(WorkItem.group_key).filter(
+            WorkItem.operation == self.operation, WorkItem.state == 'pending').distinct()}
+        # Keep the rotation position of schools seen before
+        self._groups = deque([group for group in self._groups if group in groups] +
+                             sorted(groups - set(self._groups), key=str))
+        self._groups_loaded_at = time.monotonic()
+
+    def _next_groups(self, count):
+        """The next count schools with pending work in round-robin order"""
+        selected = []
+        for _ in range(min(count, len(self._groups))):
+            selected.append(self._groups[0])
+            self._groups.rotate(-1)
+        return selected
+
+    def _schedule(self, session, now, limit):
+        """IDs of up to limit available items in the order of the priority policy"""
+        ids = []
+
+        def take(query, count):
+            for (item_id,) in query.limit(count):
+                if item_id not in ids:
+                    ids.append(item_id)
+
+        # Items with an SLA first, earliest deadline first, then items whose lease ran out
+        take(session.query(WorkItem.id).filter(
+            WorkItem.operation == self.operation, self._available(now),
+            WorkItem.deadline.isnot(None)).order_by(WorkItem.deadline), limit)
+        take(session.query(WorkItem.id).filter(
+            WorkItem.operation == self.operation, WorkItem.state == 'in_progress',
+            WorkItem.lease_expires_at < now).order_by(WorkItem.lease_expires_at), limit - len(ids))
+        if len(ids) >= limit:
+            return ids[:limit]
+        if not self.policy.fair:
+            take(self._pending(session, now).order_by(*self._by_time()), limit - len(ids))
+            return ids
+
+        # One item per school in turn, so no single school's backlog holds up the others
+        if self._groups_loaded_at is None or not self._groups or \
+                time.monotonic() - self._groups_loaded_at > self.GROUP_REFRESH_INTERVAL:
+            self._refresh_groups(session)
+        while len(ids) < limit:
+            groups = self._next_groups(limit - len(ids))
+            if not groups:
+                break
+            per_group = -(-(limit - len(ids)) // len(groups))
+            batches = []
+            for group in groups:
+                batch = [item_id for (item_id,) in self._pending(session, now).filter(
+                    WorkItem.group_key == group, WorkItem.id.notin_(ids)).order_by(*self._by_time()).limit(per_group)]
+                if batch:
+                    batches.append(deque(batch))
+                else:
+                    self._groups.remove(group)  # Nothing available here until the next refresh
+            while batches and len(ids) < limit:
+                for batch in batches[:limit - len(ids)]:
+                    ids.append(batch.popleft())
+                batches = [batch for batch in batches if batch]
+        return ids
+
+    def lease(self, owner, limit):
+        """Claim up to limit available items for owner, in priority order"""
+        if limit <= 0:
+            return []
+        now = datetime.utcnow()
+        session = CoordSession()
+        try:
+            ids = self._schedule(session, now, limit)
+            if not ids:
+                return []
+            # The availability check is repeated so an item claimed meanwhile by another instance is skipped
+            session.query(WorkItem).filter(WorkItem.id.in_(ids), self._available(now)).update(
+                {WorkItem.state: 'in_progress', WorkItem.lease_owner: owner,
+                 WorkItem.lease_expires_at: now + self.lease_duration, WorkItem.updated_at: now},
+                synchronize_session=False)
+            session.commit()
+            rows = session.query(WorkItem).filter(
+                WorkItem.id.in_(ids), WorkItem.state == 'in_progress', WorkItem.lease_owner == owner,
+                WorkItem.lease_expires_at == now + self.lease_duration)
+            position = {item_id: index for index, item_id in enumerate(ids)}
+            return [{'id': row.id, 'path': row.path, 'size': row.size, 'etag': row.etag,
+                     'attempts': row.attempts, 'last_modified': row.last_modified}
+                    for row in sorted(rows, key=lambda row: position[row.id])]
+        finally:
+            session.close()
+
+    def _update(self, ids, values, owner=None):
+        ids = list(ids)
+        if not ids:
+            return
+        values[WorkItem.updated_at] = datetime.utcnow()
+        session = CoordSession()
+        try:
+            for start in range(0, len(ids), PROCESSED_LOOKUP_CHUNK):
+                query = session.query(WorkItem).filter(WorkItem.id.in_(ids[start:start + PROCESSED_LOOKUP_CHUNK]))
+                if owner is not None:
+                    query = query.filter(WorkItem.lease_owner == owner)
+                query.update(values, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def renew(self, owner, ids):
+        """Extend owner's leases on items that are still being worked on"""
+        self._update(ids, {WorkItem.lease_expires_at: datetime.utcnow() + self.lease_duration}, owner=owner)
+
+    def complete(self, ids, owner=None):
+        """Mark items done; with owner, items whose lease has meanwhile passed to another node are left alone"""
+        self._update(ids, {WorkItem.state: 'done', WorkItem.lease_owner: None, WorkItem.lease_expires_at: None},
+                     owner=owner)
+
+    def release(self, ids, owner=None):
+        """Hand leased items back without counting an attempt, e.g. when cancelled.
+
+        With owner, items whose lease has meanwhile passed to another node are left alone.
+        """
+        self._update(ids, {WorkItem.state: 'pending', WorkItem.lease_owner: None, WorkItem.lease_expires_at: None},
+                     owner=owner)
+
+    def fail(self, item, error, owner=None):
+        """Record a failed attempt; the item is retried with backoff until max_attempts"""
+        attempts = item['attempts'] + 1
+        if attempts >= self.max_attempts:
+            values = {WorkItem.state: 'failed'}
+        else:
+            delay = timedelta(minutes=min(60, 2 ** (attempts - 1)))
+            values = {WorkItem.state: 'pending', WorkItem.available_at: datetime.utcnow() + delay}
+        values.update({WorkItem.attempts: attempts, WorkItem.last_error: str(error)[:500],
+                       WorkItem.lease_owner: None, WorkItem.lease_expires_at: None})
+        self._update([item['id']], values, owner=owner)
+        return values[WorkItem.state]
+
+    def drop_pending(self, paths):
+        """Mark the pending items with these paths done, e.g. recordings deleted from their bucket"""
+        paths = list(set(paths))
+        if not paths:
+            return
+        session = CoordSession()
+        try:
+            for start in range(0, len(paths), PROCESSED_LOOKUP_CHUNK):
+                session.query(WorkItem).filter(
+                    WorkItem.operation == self.operation,
+                    WorkItem.state == 'pending',
+                    WorkItem.path.in_(paths[start:start + PROCESSED_LOOKUP_CHUNK])).update(
+                    {WorkItem.state: 'done', WorkItem.updated_at: datetime.utcnow()}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def last_modified(self, paths):
+        """LastModified of the queued items with these paths"""
+        paths = list(set(paths))
+        found = {}
+        session = CoordSession()
+        try:
+            for start in range(0, len(paths), PROCESSED_LOOKUP_CHUNK):
+                found.update(session.query(WorkItem.path, WorkItem.last_modified).filter(
+                    WorkItem.operation == self.operation,
+                    WorkItem.path.in_(paths[start:start + PROCESSED_LOOKUP_CHUNK])))
+        finally:
+            session.close()
+        return found
+
+    def counts(self):
+        """Number of items per state"""
+        session = CoordSession()
+        try:
+            return dict(session.query(WorkItem.state, func.count(WorkItem.id)).filter(
+                WorkItem.operation == self.operation).group_by(WorkItem.state))
+        finally:
+            session.close()
+
+class NodeLeases:
+    """Named leases in the coordination database, so only one node works on a resource at a time.
+
+    A lease expires unless its owner renews it, so a node that stops responding
+    does not hold a resource for longer than the lease duration.
+    """
+    def __init__(self, duration=WORK_QUEUE_LEASE):
+        self.duration = duration
+
+    def acquire(self, resource, owner):
+        """Claim resource for owner; returns False while another owner's lease is current"""
+        now = datetime.utcnow()
+        session = CoordSession()
+        try:
+            claimed = session.query(NodeLease).filter(
+                NodeLease.resource == resource,
+                or_(NodeLease.owner == owner, NodeLease.expires_at < now)).update(
+                {NodeLease.owner: owner, NodeLease.expires_at: now + self.duration}, synchronize_session=False)
+            if not claimed:
+                session.add(NodeLease(resource=resource, owner=owner, expires_at=now + self.duration))
+            session.commit()
+            return True
+        except IntegrityError:
+            # The lease exists and is held by someone else
+            session.rollback()
+            return False
+        finally:
+            session.close()
+
+    def renew(self, resource, owner):
+        """Extend owner's lease; returns False if it was lost to another node meanwhile"""
+        session = CoordSession()
+        try:
+            renewed = session.query(NodeLease).filter(
+                NodeLease.resource == resource, NodeLease.owner == owner).update(
+                {NodeLease.expires_at: datetime.utcnow() + self.duration}, synchronize_session=False)
+            session.commit()
+            return bool(renewed)
+        finally:
+            session.close()
+
+    def release(self, resource, owner):
+        session = CoordSession()
+        try:
+            session.query(NodeLease).filter(
+                NodeLease.resource == resource, NodeLease.owner == owner).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def active(self, prefix):
+        """Whether any current lease's resource starts with prefix"""
+        session = CoordSession()
+        try:
+            return session.query(NodeLease.id).filter(
+                NodeLease.resource.startswith(prefix, autoescape=True),
+                NodeLease.expires_at >= datetime.utcnow()).first() is not None
+        finally:
+            session.close()
+
+    def holder(self, resource):
+        """Owner of the current lease on resource, or None"""
+        session = CoordSession()
+        try:
+            lease = session.query(NodeLease).filter(
+                NodeLease.resource == resource, NodeLease.expires_at >= datetime.utcnow()).first()
+            return lease.owner if lease else None
+        finally:
+            session.close()
+
+# Number of concurrent listing requests used by a scan
+SCAN_CONCURRENCY = int(os.getenv('WASABI_SCAN_CONCURRENCY', '8'))
+
+# Delta scans only re-list prefixes that changed recently or have not been listed for a
+# while, and only surface new or changed recordings; a periodic full reconcile lists
+# everything again and drops deleted objects from the manifest
+INCREMENTAL_SCAN = os.getenv('WASABI_INCREMENTAL_SCAN', '1') == '1'
+FULL_RECONCILE_INTERVAL = timedelta(hours=float(os.getenv('WASABI_FULL_RECONCILE_HOURS', '24')))
+SCAN_HOT_WINDOW = timedelta(hours=float(os.getenv('WASABI_SCAN_HOT_WINDOW_HOURS', '24')))
+SCAN_COLD_RELIST_INTERVAL = timedelta(minutes=float(os.getenv('WASABI_SCAN_COLD_RELIST_MINUTES', '60')))
+# Prefixes whose newest recording (high-water mark) is old are listed less often: after this
+# share of the time since that recording, at least the cold interval and at most the reconcile interval
+SCAN_QUIET_RELIST_FACTOR = float(os.getenv('WASABI_SCAN_QUIET_RELIST_FACTOR', '0.1'))
+MANIFEST_KEY_END = '\U0010ffff'  # Upper bound for key range queries on a prefix
+
+# Folder layout that holds recordings, e.g. '{school}/teachers/{teacher}/classes/{class}/Recording|Recordings/'.
+# Scans then walk it one folder level at a time and only list folders that match, so
+# summaries, assets and other subtrees are skipped; empty lists every folder
+SCAN_PATH_TEMPLATE = os.getenv('WASABI_SCAN_PATH_TEMPLATE', '').strip()
+# Folder names, next to a recordings folder, that summaries are uploaded to
+SUMMARY_FOLDER_NAMES = {name.strip().lower()
+                        for name in os.getenv('WASABI_SUMMARY_FOLDERS', 'Summary|Summaries').split('|')
+                        if name.strip()}
+
+class PathTemplate:
+    """A folder layout with one pattern per level: '{name}' matches any folder, 'A|B' the
+    folders named A or B, compared case-insensitively. The last level is the recordings folder.
+    """
+    def __init__(self, template):
+        self.levels = []
+        for segment in template.strip().strip('/').split('/'):
+            if segment.startswith('{') and segment.endswith('}'):
+                self.levels.append(None)
+            else:
+                self.levels.append({name.strip().lower() for name in segment.split('|')})
+
+    def matches(self, level, name):
+        names = self.levels[level]
+        return names is None or name.lower() in names
+
+    def level_of(self, prefix):
+        """Number of template levels prefix covers, or None when prefix does not fit the template"""
+        folders = [folder for folder in prefix.strip('/').split('/') if folder]
+        for level, name in enumerate(folders[:len(self.levels)]):
+            if not self.matches(level, name):
+                return None
+        return min(len(folders), len(self.levels))
+
+scan_template = PathTemplate(SCAN_PATH_TEMPLATE) if SCAN_PATH_TEMPLATE else None
+
+# Wasabi client settings
+DEFAULT_REGION = 'us-east-1'
+MAX_POOL_CONNECTIONS = int(os.getenv('WASABI_MAX_POOL_CONNECTIONS', '50'))
+REGION_CACHE_TTL = int(os.getenv('WASABI_REGION_CACHE_TTL', '3600'))  # seconds
+# Send every request to this S3-compatible endpoint instead of Wasabi (e.g. a local test server)
+ENDPOINT_URL = os.getenv('WASABI_ENDPOINT_URL')
+
+class ManifestDiff:
+    """Compares one shard's listing, page by page, against the stored manifest.
+
+    add_page() stores new or changed recordings and returns them right away, so a
+    scan can hand them on before the shard's listing has finished; finish() then
+    drops entries that were not listed again and updates the shard's ScanState.
+    Queued downloads of dropped entries are taken off work_queue, if given.
+    """
+    def __init__(self, session, bucket_name, shard, work_queue=None):
+        self.session = session
+        self.work_queue = work_queue
+        self.bucket_name = bucket_name
+        self.shard = shard
+        self.existing = {row.key: row for row in session.query(ListingManifest).filter(
+            ListingManifest.bucket == bucket_name,
+            ListingManifest.key >= shard,
+            ListingManifest.key < shard + MANIFEST_KEY_END)}
+        self.listed = 0
+        self.changed = 0
+        self.high_water_mark = None
+
+    def add_page(self, objects):
+        changed = []
+        for obj in objects:
+            etag = obj.get('ETag', '').strip('"')
+            size = obj.get('Size')
+            last_modified = obj.get('LastModified')
+            if last_modified is not None:
+                last_modified = last_modified.astimezone(timezone.utc).replace(tzinfo=None)
+                if self.high_water_mark is None or last_modified > self.high_water_mark:
+                    self.high_water_mark = last_modified
+
+            row = self.existing.pop(obj['Key'], None)
+            if row is None:
+                self.session.add(ListingManifest(bucket=self.bucket_name, key=obj['Key'], etag=etag,
+                                                 size=size, last_modified=last_modified))
+                changed.append(obj)
+            elif row.etag != etag or row.size != size:
+                row.etag = etag
+                row.size = size
+                row.last_modified = last_modified
+                changed.append(obj)
+        self.listed += len(objects)
+        self.changed += len(changed)
+        return changed
+
+    def finish(self, states, now):
+        """Store the completed listing; returns the number of recordings deleted in the bucket"""
+        # Whatever is left was not listed again, so it has been deleted
+        for row in self.existing.values():
+            self.session.delete(row)
+
+        state = states.get(self.shard)
+        if state is None:
+            state = ScanState(bucket=self.bucket_name, prefix=self.shard)
+            self.session.add(state)
+            states[self.shard] = state
+        state.last_listed_at = now
+        state.object_count = self.listed
+        if self.changed or self.existing:
+            state.last_changed_at = now
+        if self.high_water_mark and (state.high_water_mark is None
+                                     or self.high_water_mark > state.high_water_mark):
+            state.high_water_mark = self.high_water_mark
+        self.session.commit()
+        if self.work_queue is not None:
+            # Downloading a deleted recording would only fail with NoSuchKey
+            self.work_queue.drop_pending([self.bucket_name + '/' + key for key in self.existing])
+        return len(self.existing)
+
+class WasabiClientRegistry:
+    """Process-wide cache of bucket regions and pooled regional S3 clients.
+
+    boto3 clients are thread-safe once created, so one client (and one connection
+    pool) per region is shared by every worker, operation and thread.
+    """
+    def __init__(self, max_pool_connections=MAX_POOL_CONNECTIONS, region_ttl=REGION_CACHE_TTL):
+        self.max_pool_connections = max_pool_connections
+        self.region_ttl = region_ttl
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._regions = {}  # bucket name -> (region, expiry as time.monotonic())
+
+    def client_for_region(self, region=DEFAULT_REGION):
+        with self._lock:
+            client = self._clients.get(region)
+            if client is None:
+                client = boto3.client(
+                    's3',
+                    endpoint_url=ENDPOINT_URL or f'https://s3.{region}.wasabisys.com',
+                    aws_access_key_id=os.getenv('WASABI_ACCESS_KEY'),
+                    aws_secret_access_key=os.getenv('WASABI_SECRET_KEY'),
+                    region_name=region,
+                    config=Config(max_pool_connections=self.max_pool_connections)
+                )
+                self._clients[region] = client
+            return client
+
+    def default_client(self):
+        return self.client_for_region(DEFAULT_REGION)
+
+    def region_for_bucket(self, bucket_name):
+        """Return the bucket's region, asking Wasabi only when the cached entry has expired"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._regions.get(bucket_name)
+            if cached and cached[1] > now:
+                return cached[0]
+
+        bucket_location = self.default_client().get_bucket_location(Bucket=bucket_name)
+        region = bucket_location['LocationConstraint'] or DEFAULT_REGION  # None means us-east-1
+        with self._lock:
+            self._regions[bucket_name] = (region, now + self.region_ttl)
+        return region
+
+    def client_for_bucket(self, bucket_name):
+        return self.client_for_region(self.region_for_bucket(bucket_name))
+
+    def invalidate(self, bucket_name):
+        """Forget a bucket's cached region, e.g. after a regional request failed"""
+        with self._lock:
+            self._regions.pop(bucket_name, None)
+
+client_registry = WasabiClientRegistry()
+
+# Transfer settings: recordings are fetched DOWNLOAD_CONCURRENCY at a time, and anything
+# above the multipart threshold is split into ranged parts fetched in parallel
+DOWNLOAD_CONCURRENCY = int(os.getenv('WASABI_DOWNLOAD_CONCURRENCY', '4'))
+MB = 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv('WASABI_MULTIPART_THRESHOLD_MB', '16')) * MB,
+    multipart_chunksize=int(os.getenv('WASABI_MULTIPART_CHUNKSIZE_MB', '16')) * MB,
+    max_concurrency=int(os.getenv('WASABI_MULTIPART_CONCURRENCY', '4')),
+    use_threads=True
+)
+
+# Summaries are small, so more of them are uploaded at once
+UPLOAD_CONCURRENCY = int(os.getenv('WASABI_UPLOAD_CONCURRENCY', '8'))
+
+# A recording with the same ETag and size as one already downloaded is not downloaded again:
+# it references the first copy, and that copy's summary is uploaded for both
+DEDUP_CONTENT = os.getenv('WASABI_DEDUP', '1') == '1'
+DEDUP_HARDLINKS = os.getenv('WASABI_DEDUP_HARDLINKS', '0') == '1'  # Also hardlink duplicates under their own name
+# Multipart ETags differ when the same file was uploaded with another part size; hashing
+# downloaded multipart recordings catches those duplicates after the download
+DEDUP_HASH_MULTIPART = os.getenv('WASABI_DEDUP_HASH_MULTIPART', '0') == '1'
+
+# Disk budget for the download folder; 0 means no limit. Over budget, recordings whose summaries
+# have been uploaded are deleted oldest first, and downloads pause until enough space is freed
+DISK_BUDGET = int(float(os.getenv('WASABI_DISK_BUDGET_GB', '0')) * 1024 ** 3)
+DISK_BUDGET_LOW_WATERMARK = 0.9  # Eviction frees space down to this share of the budget
+# A cycle paused this long by the budget stops downloading; the next cycle continues
+DISK_BUDGET_PAUSE_LIMIT = float(os.getenv('WASABI_DISK_BUDGET_PAUSE_SECONDS', '300'))
+DISK_USAGE_RESCAN_INTERVAL = 30  # seconds between rescans of the download folder while paused
+
+# Optional stage after download that converts recordings to a compact speech profile with ffmpeg
+TRANSCODE = os.getenv('WASABI_TRANSCODE', '0') == '1'
+FFMPEG = os.getenv('WASABI_FFMPEG', 'ffmpeg')
+TRANSCODE_EXTENSION = os.getenv('WASABI_TRANSCODE_EXTENSION', '.opus')
+TRANSCODE_CODEC = os.getenv('WASABI_TRANSCODE_CODEC', 'libopus')
+TRANSCODE_BITRATE = os.getenv('WASABI_TRANSCODE_BITRATE', '24k')
+TRANSCODE_SAMPLE_RATE = int(os.getenv('WASABI_TRANSCODE_SAMPLE_RATE', '16000'))
+TRANSCODE_CONCURRENCY = int(os.getenv('WASABI_TRANSCODE_CONCURRENCY', str(os.cpu_count() or 2)))
+TRANSCODE_KEEP_ORIGINAL = os.getenv('WASABI_TRANSCODE_KEEP_ORIGINAL', '0') == '1'
+# ffmpeg output formats for extensions whose format name differs
+TRANSCODE_FORMATS = {'.opus': 'ogg', '.oga': 'ogg', '.m4a': 'ipod', '.aac': 'adts'}
+
+def _transcode_file(ffmpeg, source_path, output_path):
+    """Convert one recording to mono speech audio; runs in a worker process and returns the output size"""
+    temp_path = output_path + '.part'
+    extension = os.path.splitext(output_path)[1].lower()
+    command = [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', '-i', source_path,
+               '-vn', '-ac', '1', '-ar', str(TRANSCODE_SAMPLE_RATE), '-c:a', TRANSCODE_CODEC, '-b:a', TRANSCODE_BITRATE,
+               '-f', TRANSCODE_FORMATS.get(extension, extension.lstrip('.')), temp_path]
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            message = result.stderr.decode(errors='replace').strip().splitlines()
+            raise RuntimeError(message[-1] if message else f"ffmpeg exited with code {result.returncode}")
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.path.getsize(output_path)
+
+# Transfer scheduling: requests in flight across all transfers, retries and an optional bandwidth cap
+MAX_CONCURRENT_REQUESTS = int(os.getenv(
+    'WASABI_MAX_CONCURRENT_REQUESTS',
+    str(DOWNLOAD_CONCURRENCY * TRANSFER_CONFIG.max_concurrency + UPLOAD_CONCURRENCY)))
+RETRY_ATTEMPTS = int(os.getenv('WASABI_RETRY_ATTEMPTS', '6'))
+RETRY_BASE_DELAY = float(os.getenv('WASABI_RETRY_BASE_DELAY', '0.5'))  # seconds
+RETRY_MAX_DELAY = float(os.getenv('WASABI_RETRY_MAX_DELAY', '30'))  # seconds
+BANDWIDTH_LIMIT = float(os.getenv('WASABI_BANDWIDTH_LIMIT_MBIT', '0')) * 1000 * 1000 / 8  # bytes/s, 0 = no cap
+
+# S3 error codes worth retrying; throttling ones also make the scheduler back off
+THROTTLE_ERROR_CODES = {'SlowDown', 'ServiceUnavailable', 'Throttling', 'ThrottlingException',
+                        'RequestLimitExceeded', 'TooManyRequests', '503', '429'}
+TRANSIENT_ERROR_CODES = {'RequestTimeout', 'InternalError', '500', '502', '504'}
+
+def _format_bytes(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024 or unit == 'GB':
+            return f"{num_bytes:.1f} {unit}" if unit != 'B' else f"{num_bytes} B"
+        num_bytes /= 1024
+
+class TransferProgress:
+    """Thread-safe per-file and aggregate byte counters for a batch of transfers.
+
+    A progress line is logged each time a file crosses another `report_step` percent,
+    so large files report steadily without flooding the log.
+    """
+    def __init__(self, log, verb, report_step=25):
+        self.log = log
+        self.verb = verb
+        self.report_step = report_step
+        self.total_bytes = 0
+        self.transferred_bytes = 0
+        self._files = {}  # name -> [bytes done, size, last reported step]
+        self._lock = threading.Lock()
+
+    def add_file(self, name, size):
+        with self._lock:
+            if name not in self._files:
+                self._files[name] = [0, size, 0]
+                self.total_bytes += size
+
+    def restart(self, name):
+        """Discard a file's progress before it is transferred again"""
+        with self._lock:
+            entry = self._files.get(name)
+            if entry:
+                self.transferred_bytes -= entry[0]
+                entry[0] = 0
+                entry[2] = 0
+
+    def callback(self, name):
+        return lambda bytes_amount: self.update(name, bytes_amount)
+
+    def update(self, name, bytes_amount):
+        with self._lock:
+            entry = self._files.get(name)
+            if entry is None:
+                return
+            entry[0] += bytes_amount
+            self.transferred_bytes += bytes_amount
+            done, size, last_step = entry
+            percent = 100 if size == 0 else min(100, done * 100 // size)
+            step = percent // self.report_step
+            if step <= last_step:
+                return
+            entry[2] = step
+            total_percent = 100 if self.total_bytes == 0 else self.transferred_bytes * 100 // self.total_bytes
+            message = (f"{self.verb} {name}: {percent}% ({_format_bytes(done)} of {_format_bytes(size)}) - "
+                       f"total {_format_bytes(self.transferred_bytes)} of {_format_bytes(self.total_bytes)} ({total_percent}%)")
+        # Only multipart-sized files report progress in the window; the rest finish within seconds
+        self.log(message, level=logging.INFO if size >= TRANSFER_CONFIG.multipart_threshold else logging.DEBUG)
+
+def _transfer_error_kind(error):
+    """'throttle' for throttling and timeouts, 'transient' for other retryable errors, else None"""
+    if isinstance(error, S3UploadFailedError) and error.__context__ is not None:
+        error = error.__context__  # upload_file wraps the ClientError
+    if isinstance(error, ClientError):
+        code = str(error.response.get('Error', {}).get('Code', ''))
+        status = str(error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', ''))
+        if code in THROTTLE_ERROR_CODES or status in ('429', '503'):
+            return 'throttle'
+        if code in TRANSIENT_ERROR_CODES or status in ('500', '502', '504'):
+            return 'transient'
+        return None
+    if isinstance(error, (ReadTimeoutError, ConnectTimeoutError, TimeoutError)):
+        return 'throttle'
+    if isinstance(error, (BotoConnectionError, HTTPClientError, ConnectionError)):
+        return 'transient'
+    return None
+
+class TransferScheduler:
+    """Process-wide gate for Wasabi transfer requests: retries, AIMD concurrency and a bandwidth cap.
+
+    Every part download and summary upload runs through run(). Throttling, timeouts
+    and transient network errors are retried with full-jitter exponential backoff.
+    The number of requests allowed in flight grows by one after a window of
+    successful requests that were not slower than usual, and is halved whenever
+    Wasabi throttles or times out, so it settles just below what the account and the
+    link sustain. throttle() draws from a token bucket shared by all transfers.
+    """
+    def __init__(self, max_concurrency=MAX_CONCURRENT_REQUESTS, max_attempts=RETRY_ATTEMPTS,
+                 base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY, bandwidth_limit=BANDWIDTH_LIMIT,
+                 slow_factor=2.0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bandwidth_limit = bandwidth_limit
+        self.slow_factor = slow_factor
+        self.limit = self.max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._baseline = None  # Fastest recent seconds per MB
+        self._condition = threading.Condition()
+        self._tokens = bandwidth_limit
+        self._refilled_at = time.monotonic()
+        self._bucket_lock = threading.Lock()
+
+    def run(self, fn, *args, size=0, description='request', log=None, on_retry=None, **kwargs):
+        """Call fn(*args, **kwargs) within the concurrency limit, retrying retryable errors"""
+        attempt = 1
+        while True:
+            self._acquire()
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as error:
+                kind = _transfer_error_kind(error)
+                self._release(throttled=kind == 'throttle')
+                if kind is None or attempt >= self.max_attempts:
+                    raise
+                metrics.inc('wasabi_retries_total', kind=kind)
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if log:
+                    log(f"Retrying {description} in {delay:.1f}s (attempt {attempt + 1} of "
+                        f"{self.max_attempts}, {self.limit} requests in flight allowed): {str(error)}",
+                        level=logging.WARNING)
+                if on_retry:
+                    on_retry()
+                time.sleep(delay)
+                attempt += 1
+                continue
+            elapsed = time.monotonic() - started
+            metrics.observe('wasabi_transfer_request_seconds', elapsed)
+            self._release(seconds_per_mb=elapsed * MB / max(size, MB))
+            return result
+
+    def _acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+            metrics.set_gauge('wasabi_transfer_requests_in_flight', self._in_flight)
+
+    def _release(self, throttled=False, seconds_per_mb=None):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                # Multiplicative decrease
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            elif seconds_per_mb is not None:
+                # The baseline slowly forgets old optimums so it follows a changing link
+                baseline = self._baseline
+                self._baseline = seconds_per_mb if baseline is None else min(seconds_per_mb, baseline * 1.01)
+                if baseline is not None and seconds_per_mb > baseline * self.slow_factor:
+                    self._successes = 0  # Slower than usual: hold the current limit
+                else:
+                    self._successes += 1
+                    if self._successes >= self.limit and self.limit < self.max_concurrency:
+                        # Additive increase after a full window of good requests
+                        self.limit += 1
+                        self._successes = 0
+            metrics.set_gauge('wasabi_transfer_requests_in_flight', self._in_flight)
+            metrics.set_gauge('wasabi_transfer_concurrency_limit', self.limit)
+            self._condition.notify_all()
+
+    def throttle(self, num_bytes):
+        """Wait until num_bytes fit within the bandwidth cap (no-op without a cap)"""
+        if not self.bandwidth_limit:
+            return
+        with self._bucket_lock:
+            now = time.monotonic()
+            # Up to one second of unused bandwidth can be spent as a burst
+            self._tokens = min(self.bandwidth_limit,
+                               self._tokens + (now - self._refilled_at) * self.bandwidth_limit)
+            self._refilled_at = now
+            self._tokens -= num_bytes
+            delay = -self._tokens / self.bandwidth_limit if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+transfer_scheduler = TransferScheduler()
+
+class ObjectChangedError(Exception):
+    """The object was replaced in Wasabi while it was being downloaded"""
+
+class ResumableDownload:
+    """Downloads one object to `<local_path>.part` in ranged parts that survive failures.
+
+    Completed part numbers are saved in a `.part.json` sidecar with the object's ETag
+    and size, so a failed or interrupted download continues with the missing parts
+    instead of starting over. Every ranged GET carries IfMatch, so parts of two
+    versions are never combined. The finished file is checked against the size and,
+    for single-part uploads, the MD5 ETag before it is renamed into place; multipart
+    ETags depend on the uploader's part size, so those rely on the per-part IfMatch.
+    """
+    def __init__(self, s3, bucket_name, object_key, local_path, size, etag,
+                 part_size=TRANSFER_CONFIG.multipart_chunksize, concurrency=TRANSFER_CONFIG.max_concurrency,
+                 scheduler=None, log=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.local_path = local_path
+        self.size = size
+        self.etag = etag
+        self.part_size = part_size
+        self.concurrency = max(1, concurrency)
+        self.scheduler = scheduler or transfer_scheduler
+        self.log = log
+        self.part_path = local_path + '.part'
+        self.state_path = local_path + '.part.json'
+        self.part_count = -(-size // part_size)
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def _part_range(self, number):
+        start = number * self.part_size
+        return start, min(self.size, start + self.part_size) - 1
+
+    def _load_state(self):
+        """Parts already on disk from an earlier attempt at the same object version"""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if (state.get('etag') != self.etag or state.get('size') != self.size
+                or state.get('part_size') != self.part_size
+                or not os.path.exists(self.part_path) or os.path.getsize(self.part_path) != self.size):
+            return set()
+        return set(state.get('done', [])) & set(range(self.part_count))
+
+    def _save_state(self):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'etag': self.etag, 'size': self.size, 'part_size': self.part_size,
+                       'done': sorted(self._done)}, f)
+        os.replace(temp_path, self.state_path)
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def run(self, callback=None, should_stop=None):
+        """Fetch the missing parts, verify the file and move it to local_path"""
+        self._done = self._load_state()
+        if self._done:
+            if callback:
+                callback(sum(end - start + 1 for start, end in map(self._part_range, self._done)))
+        else:
+            with open(self.part_path, 'wb') as f:
+                f.truncate(self.size)
+            self._save_state()
+
+        missing = [number for number in range(self.part_count) if number not in self._done]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(missing))) as pool:
+                futures = [pool.submit(self._fetch_part, number, callback, should_stop) for number in missing]
+                try:
+                    for future in futures:
+                        future.result()
+                except ObjectChangedError:
+                    for future in futures:
+                        future.cancel()
+                    pool.shutdown()
+                    self.discard()
+                    raise
+                except Exception:
+                    # Parts that finished stay recorded for the next attempt
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        self._verify()
+        os.replace(self.part_path, self.local_path)
+        os.remove(self.state_path)
+
+    def _fetch_part(self, number, callback, should_stop):
+        if should_stop and should_stop():
+            raise RuntimeError("Download stopped; it resumes from the completed parts next time")
+        start, end = self._part_range(number)
+        self.scheduler.run(self._fetch_range, number, start, end, callback, size=end - start + 1,
+                           description=f"part {number + 1} of {self.object_key}", log=self.log)
+        with self._lock:
+            self._done.add(number)
+            self._save_state()
+
+    def _fetch_range(self, number, start, end, callback):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=self.object_key,
+                                          Range=f'bytes={start}-{end}', IfMatch=f'"{self.etag}"')
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', '412'):
+                raise ObjectChangedError(f"{self.object_key} changed during the download") from e
+            raise
+
+        written = 0
+        body = response['Body']
+        try:
+            with open(self.part_path, 'r+b') as f:
+                f.seek(start)
+                for chunk in iter(lambda: body.read(MB), b''):
+                    self.scheduler.throttle(len(chunk))
+                    f.write(chunk)
+                    written += len(chunk)
+                    if callback:
+                        callback(len(chunk))
+                # The part only counts as done once it is on disk
+                f.flush()
+                os.fsync(f.fileno())
+            if written != end - start + 1:
+                raise ConnectionError(f"Part {number + 1} of {self.object_key} was cut short")
+        except Exception:
+            if callback and written:
+                callback(-written)  # The part is fetched again from its start
+            raise
+        metrics.inc('wasabi_bytes_downloaded_total', written)
+
+    def _verify(self):
+        actual_size = os.path.getsize(self.part_path)
+        if actual_size != self.size:
+            self.discard()
+            raise IOError(f"Size mismatch for {self.object_key}: got {actual_size} of {self.size} bytes")
+        if _is_md5_etag(self.etag):
+            md5 = hashlib.md5()
+            with open(self.part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(MB), b''):
+                    md5.update(chunk)
+            if md5.hexdigest() != self.etag.lower():
+                self.discard()
+                raise IOError(f"Checksum mismatch for {self.object_key}; the partial file was discarded")
+
+class LocalStorageManager:
+    """Keeps the download folder within a disk budget.
+
+    Usage is counted once from the folder and then kept up to date with reserve() as
+    downloads start, with a fresh count at most every DISK_USAGE_RESCAN_INTERVAL seconds
+    while over budget. evict() deletes downloaded recordings, least recently used first,
+    but only once the summary of every recording that file stands for has been uploaded;
+    the download records stay, so evicted recordings are not downloaded again.
+    """
+    def __init__(self, directory, budget=DISK_BUDGET, rescan_interval=DISK_USAGE_RESCAN_INTERVAL):
+        self.directory = directory
+        self.budget = budget
+        self.rescan_interval = rescan_interval
+        self._usage = None
+        self._counted_at = 0
+
+    def _files(self):
+        """(name, size, last used) of every file in the folder; hardlinked copies are counted once"""
+        files = []
+        inodes = set()
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return files
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            size = 0 if (stat.st_dev, stat.st_ino) in inodes else stat.st_size
+            inodes.add((stat.st_dev, stat.st_ino))
+            files.append((entry.name, size, max(stat.st_atime, stat.st_mtime)))
+        return files
+
+    def usage(self, refresh=False):
+        if refresh or self._usage is None:
+            self._usage = sum(size for _, size, _ in self._files())
+            self._counted_at = time.monotonic()
+            metrics.set_gauge('wasabi_local_storage_bytes', self._usage)
+        return self._usage
+
+    def reserve(self, num_bytes):
+        """Count a download that is starting"""
+        self.usage()
+        self._usage += num_bytes or 0
+
+    def has_room(self, num_bytes=0):
+        if self.budget <= 0:
+            return True
+        if self.usage() + num_bytes <= self.budget:
+            return True
+        # Summaries may have been uploaded or files deleted by hand since the last count
+        if time.monotonic() - self._counted_at >= self.rescan_interval:
+            return self.usage(refresh=True) + num_bytes <= self.budget
+        return False
+
+    def evict(self, log=None):
+        """Delete summarized recordings, oldest first, until usage is below the low watermark.
+
+        Uses a session of its own, so uploads committed by other threads meanwhile are seen.
+        Returns (files deleted, bytes freed).
+        """
+        if self.budget <= 0:
+            return 0, 0
+        files = self._files()
+        usage = self._usage = sum(size for _, size, _ in files)
+        target = self.budget * DISK_BUDGET_LOW_WATERMARK
+        if usage <= target:
+            return 0, 0
+
+        # Which local files stand for which recordings; files without a download record are never deleted
+        base_names = list({os.path.splitext(name)[0] for name, _, _ in files
+                           if not name.endswith(('.part', '.json'))})
+        recordings = {}
+        session = Session()
+        try:
+            for start in range(0, len(base_names), PROCESSED_LOOKUP_CHUNK):
+                rows = session.query(ProcessedFile.local_timestamp, ProcessedFile.file_path).filter(
+                    ProcessedFile.operation == 'download',
+                    ProcessedFile.local_timestamp.in_(base_names[start:start + PROCESSED_LOOKUP_CHUNK]))
+                for row in rows:
+                    recordings.setdefault(row.local_timestamp, []).append(row.file_path)
+            summary_folders = summary_folders_for([path for paths in recordings.values() for path in paths])
+            uploaded = processed_paths(session, [summary_path_for(path, summary_folders)
+                                                 for paths in recordings.values() for path in paths], 'upload')
+        finally:
+            session.close()
+
+        evicted_files = evicted_bytes = 0
+        for name, size, _ in sorted(files, key=lambda file: file[2]):
+            if usage <= target:
+                break
+            paths = recordings.get(os.path.splitext(name)[0])
+            if name.endswith(('.part', '.json')) or not paths \
+                    or any(summary_path_for(path, summary_folders) not in uploaded for path in paths):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            usage -= size
+            evicted_files += 1
+            evicted_bytes += size
+            if log:
+                log(f"Removed {name} to stay within the disk budget; its summary is uploaded", logging.DEBUG)
+
+        self._usage = usage
+        self._counted_at = time.monotonic()
+        metrics.set_gauge('wasabi_local_storage_bytes', usage)
+        metrics.inc('wasabi_evicted_files_total', evicted_files)
+        metrics.inc('wasabi_evicted_bytes_total', evicted_bytes)
+        return evicted_files, evicted_bytes
+
+class WasabiWorker:
+    def __init__(self, operation, source_path=None, destination_path=None, start_path=None,
+                 scan_concurrency=None, download_concurrency=None, upload_concurrency=None,
+                 full_scan=False, transcode_concurrency=None):
+        self.operation = operation
+        self.source_path = source_path
+        self.destination_path = destination_path
+        self.start_path = start_path
+        self.scan_concurrency = max(1, scan_concurrency or SCAN_CONCURRENCY)
+        self.download_concurrency = max(1, download_concurrency or DOWNLOAD_CONCURRENCY)
+        self.upload_concurrency = max(1, upload_concurrency or UPLOAD_CONCURRENCY)
+        self.transcode_concurrency = max(1, transcode_concurrency or TRANSCODE_CONCURRENCY)
+        self.full_scan = full_scan or not INCREMENTAL_SCAN
+        self.session = Session()
+        self.work_queue = WorkQueue('download')  # Scans add recordings, downloads lease them
+        self.node_leases = NodeLeases()
+        self._scan_lease = None  # Resource this node's scan holds in the coordination database
+        self.found_count = 0  # Recordings listed by this scan
+        self.queued_count = 0  # ... of which were new or changed and queued for download
+        self.scan_finished = None  # Event set when a concurrent scan is done; downloads keep polling until then
+        self.download_finished = None  # Same for the transcode stage and a concurrent download
+        self.upload_requested = None  # Called to upload summaries when the disk budget pauses downloads
+        self.downloaded_paths = None  # Shared dict of local base name -> Wasabi path, filled as downloads finish
+        self.download_limit = None  # Download at most this many recordings
+        self.duplicate_count = 0  # Recordings not downloaded because their content already was
+        self.specific_files = None  # when set, upload only these file names from source_path
+        self._uncommitted = []  # ProcessedFile rows added since the last commit
+        self._surfaced = []  # Recordings listed but not yet added to the work queue
+        self._completed_items = []  # Work queue items finished since the last commit
+        self.progress_callback = None
+        self.finished_callback = None
+        self.error_callback = None
+        # Messages logged from pool threads wait here until the starting thread relays them
+        self._owner_thread = None
+        self._pending_logs = deque()
+        self._abort_listing = threading.Event()
+        self._cancel_event = threading.Event()
+
+    def set_callbacks(self, progress_cb, finished_cb, error_cb):
+        self.progress_callback = progress_cb
+        self.finished_callback = finished_cb
+        self.error_callback = error_cb
+
+    def cancel(self):
+        """Stop starting new objects; downloads in progress stop after their current part
+        and resume from there next time, other transfers in progress are allowed to finish.
+
+        Safe to call from any thread.
+        """
+        self._cancel_event.set()
+        self._abort_listing.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def log(self, message, level=logging.INFO):
+        """Log to the file; INFO and above (WASABI_UI_LOG_LEVEL) also go to progress_callback"""
+        logger.log(level, message)
+        if self.progress_callback and level >= UI_LOG_LEVEL:
+            if self._owner_thread is not None and threading.get_ident() != self._owner_thread:
+                self._pending_logs.append(message)
+            else:
+                self.progress_callback(message)
+
+    def _flush_logs(self):
+        """Relay messages queued by pool threads from the thread that called start()"""
+        while self._pending_logs:
+            message = self._pending_logs.popleft()
+            if self.progress_callback:
+                self.progress_callback(message)
+
+    def _iter_completed(self, futures):
+        """Yield futures as they finish, relaying pool-thread log messages while waiting.
+
+        Once the worker is cancelled, futures that have not started are cancelled and skipped.
+        """
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            self._flush_logs()
+            if self.cancelled:
+                pending = {future for future in pending if not future.cancel()}
+            for future in done:
+                if not future.cancelled():
+                    yield future
+        self._flush_logs()
+
+    def error(self, message):
+        logger.error(message)
+        if self.error_callback:
+            self.error_callback(message)
+
+    def _record_processed(self, file_path, operation, local_timestamp, content_key=None, content_hash=None):
+        """Add a ProcessedFile row; rows are committed every PROCESSED_COMMIT_BATCH"""
+        processed_file = ProcessedFile(
+            file_path=file_path,
+            operation=operation,
+            local_timestamp=local_timestamp,
+            file_id=_file_id_for(file_path) if operation == 'download' else None,
+            content_key=content_key,
+            content_hash=content_hash
+        )
+        self.session.add(processed_file)
+        self._uncommitted.append(processed_file)
+        if operation == 'download' and self.downloaded_paths is not None:
+            # Lets a concurrent transcode stage map the file before the row is committed
+            self.downloaded_paths.setdefault(local_timestamp, file_path)
+        if len(self._uncommitted) >= PROCESSED_COMMIT_BATCH:
+            self._commit_processed()
+        return processed_file
+
+    def _processed_paths(self, paths, operation):
+        """processed_paths() including rows recorded by this worker but not committed yet"""
+        found = processed_paths(self.session, paths, operation)
+        found.update(row.file_path for row in self._uncommitted if row.operation == operation)
+        return found
+
+    def _downloads_by_content(self, content_keys=(), content_hashes=()):
+        """downloads_by_content() including rows recorded by this worker but not committed yet"""
+        by_key, by_hash = downloads_by_content(self.session, content_keys, content_hashes)
+        content_keys, content_hashes = set(content_keys), set(content_hashes)
+        for row in self._uncommitted:
+            if row.operation != 'download':
+                continue
+            if row.content_key and row.content_key in content_keys:
+                by_key.setdefault(row.content_key, []).append(row)
+            if row.content_hash and row.content_hash in content_hashes:
+                by_hash.setdefault(row.content_hash, []).append(row)
+        return by_key, by_hash
+
+    def _commit_processed(self):
+        rows, self._uncommitted = self._uncommitted, []
+        completed, self._completed_items = self._completed_items, []
+        try:
+            self._commit_processed_rows(rows)
+        except Exception:
+            # The download records were not saved; hand the items back so they are downloaded again
+            self.session.rollback()
+            self.work_queue.release(completed, owner=NODE_ID)
+            raise
+        # Items are only marked done once their download records are saved
+        self.work_queue.complete(completed, owner=NODE_ID)
+
+    def _commit_processed_rows(self, rows):
+        if not rows:
+            return
+        try:
+            with metrics.timer('wasabi_db_commit_seconds'):
+                self.session.commit()
+        except IntegrityError:
+            # Another instance recorded some of these meanwhile; keep the rest one by one
+            self.session.rollback()
+            for row in rows:
+                try:
+                    self.session.add(ProcessedFile(file_path=row.file_path, operation=row.operation,
+                                                   local_timestamp=row.local_timestamp, file_id=row.file_id,
+                                                   content_key=row.content_key, content_hash=row.content_hash))
+                    self.session.commit()
+                except IntegrityError:
+                    self.session.rollback()
+
+    def start(self):
+        self._owner_thread = threading.get_ident()
+        try:
+            # Shared default-region Wasabi client
+            s3 = client_registry.default_client()
+
+            metrics.inc('wasabi_stage_runs_total', stage=self.operation)
+            with profiled(self.operation), metrics.timer('wasabi_stage_seconds', stage=self.operation):
+                if self.operation == 'scan':
+                    self._scan_wasabi(s3)
+                elif self.operation == 'download':
+                    self._download_files(s3)
+                elif self.operation == 'upload':
+                    self._upload_files(s3)
+                elif self.operation == 'transcode':
+                    self._transcode_files()
+                elif self.operation == 'reconcile':
+                    self._reconcile_summaries()
+                    if self.source_path and not self.cancelled:
+                        # Summaries deleted in Wasabi are uploaded again from the upload folder
+                        self._upload_files(s3)
+
+        except Exception as e:
+            self.error(str(e))
+        finally:
+            try:
+                self._flush_surfaced()
+                self._commit_processed()
+            except Exception as e:
+                self.error(f"Failed to save processed files: {str(e)}")
+            self.session.close()
+            if self.finished_callback:
+                self.finished_callback()
+
+    def _is_audio_file(self, filename):
+        """Check if the file is an audio file based on extension."""
+        audio_extensions = {'.mp3', '.wav', '.ogg', '.m4a', '.aac', '.wma', '.flac', '.alac', '.aiff'}
+        return any(filename.lower().endswith(ext) for ext in audio_extensions)
+
+    def _get_summary_path(self, path, summary_folders=None):
+        """Convert a recording path to its corresponding summary path"""
+        return summary_path_for(path, summary_folders)
+
+    def _scan_wasabi(self, s3):
+        """Scan every bucket; with a coordination database only one node scans a start path at a time"""
+        if not COORDINATED:
+            self._scan_buckets(s3)
+            return
+        resource = f"scan:{(self.start_path or '').strip().strip('/')}"
+        if not self.node_leases.acquire(resource, NODE_ID):
+            self.log(f"Node {self.node_leases.holder(resource)} is scanning; this node downloads from the shared queue")
+            return
+        self._scan_lease = resource
+        self._scan_lease_renewed_at = time.monotonic()
+        try:
+            self._scan_buckets(s3)
+        finally:
+            self._scan_lease = None
+            self.node_leases.release(resource, NODE_ID)
+
+    def _scan_buckets(self, s3):
+        try:
+            # First try to list buckets
+            try:
+                buckets = s3.list_buckets()
+                bucket_names = [bucket['Name'] for bucket in buckets['Buckets']]
+                total_buckets = len(bucket_names)
+                self.log(f"Found {total_buckets} buckets. Starting scan with {self.scan_concurrency} workers...")
+
+                # Normalise the starting path once for every bucket
+                start_path = ''
+                if self.start_path:
+                    start_path = self.start_path.strip()
+                    if not start_path.endswith('/'):
+                        start_path += '/'
+
+                # Buckets due a full reconcile list every shard and drop deleted recordings
+                now = datetime.utcnow()
+                bucket_states = {}
+                full_buckets = set()
+                for bucket_name in bucket_names:
+                    states = bucket_states[bucket_name] = {state.prefix: state for state in
+                                                           self.session.query(ScanState).filter_by(bucket=bucket_name)}
+                    root_state = states.get(start_path)
+                    if (self.full_scan or root_state is None or root_state.last_full_scan_at is None
+                            or now - root_state.last_full_scan_at >= FULL_RECONCILE_INTERVAL):
+                        full_buckets.add(bucket_name)
+
+                with ThreadPoolExecutor(max_workers=self.scan_concurrency) as pool:
+                    # Resolve every bucket's region and split its keyspace into shards concurrently
+                    plans = {}
+                    futures = {pool.submit(self._plan_bucket_scan, name, start_path): name for name in bucket_names}
+                    for future in self._iter_completed(futures):
+                        bucket_name = futures[future]
+                        try:
+                            plans[bucket_name] = future.result()
+                        except Exception as bucket_error:
+                            self.log(f"Error accessing bucket '{bucket_name}': {str(bucket_error)}", level=logging.WARNING)
+                        self._renew_scan_lease()
+                    if self.cancelled:
+                        self.log("Scan cancelled.")
+                        return
+                    if self._abort_listing.is_set():
+                        # Another node took over the scan while this one was planning
+                        return
+
+                    # Delta scans only list shards that are new, recently changed or due a re-list
+                    listed_shards = {}
+                    for bucket_name, plan in plans.items():
+                        states = plan['states'] = bucket_states[bucket_name]
+                        if bucket_name in full_buckets:
+                            listed_shards[bucket_name] = list(plan['shards'])
+                        else:
+                            listed_shards[bucket_name] = [shard for shard in plan['shards']
+                                                          if self._shard_is_due(states.get(shard), now)]
+
+                    # Recordings directly at the start path come from the planning listing itself
+                    for bucket_name, plan in plans.items():
+                        self._store_summary_folders(bucket_name, plan['summary_folders'])
+                        plan['changed'] = 0
+                        plan['deleted'] = 0
+                        for obj in plan['recordings']:
+                            self._surface_recording(bucket_name, obj)
+                    self._flush_surfaced()
+
+                    # Flat-list the selected shards on the same bounded pool; listing pages stream
+                    # back through a bounded queue so recordings are handed on as they are found
+                    pages = queue.Queue(maxsize=self.scan_concurrency * 4)
+                    futures = {}
+                    for bucket_name, plan in plans.items():
+                        for shard in listed_shards[bucket_name]:
+                            future = pool.submit(self._list_shard, plan['client'], bucket_name, shard, pages)
+                            futures[future] = (bucket_name, shard)
+
+                    try:
+                        self._consume_listings(futures, pages, plans, full_buckets, now)
+                    except BaseException:
+                        # Release listing threads blocked on the full pages queue before the pool shuts down
+                        self._abort_listing.set()
+                        raise
+
+                if self.cancelled:
+                    # Shards that finished keep their manifest updates; the rest are listed next time
+                    self.log(f"Scan cancelled. Found {self.found_count} recordings before stopping.")
+                    return
+
+                buckets_scanned = 0
+                for bucket_name in bucket_names:
+                    plan = plans.get(bucket_name)
+                    if plan is None:
+                        continue
+                    buckets_scanned += 1
+                    full = bucket_name in full_buckets
+
+                    if full:
+                        self._finish_reconcile(bucket_name, start_path, plan['shards'], plan['states'], now)
+                    else:
+                        # Recordings listed earlier that were never downloaded are surfaced again
+                        for obj in self._pending_manifest_objects(bucket_name, start_path):
+                            self._surface_recording(bucket_name, obj)
+                        self._flush_surfaced()
+
+                    scan_kind = 'full reconcile' if full else 'delta scan'
+                    self.log(f"Completed {scan_kind} of bucket '{bucket_name}' in region {plan['region']}: "
+                             f"listed {len(listed_shards[bucket_name])} of {len(plan['shards'])} prefixes, "
+                             f"{plan['changed']} new or changed, {plan['deleted']} deleted")
+
+                summary = (f"Deep scan complete. Scanned {buckets_scanned} buckets, found {self.found_count} "
+                           f"recordings, {self.queued_count} new or changed queued for download.")
+                self.log(summary)
+
+            except Exception as e:
+                self.error(f"Failed to list buckets. Error: {str(e)}")
+                return
+
+        except Exception as e:
+            self.error(f"Error during Wasabi scan: {str(e)}")
+
+    def _plan_bucket_scan(self, bucket_name, start_path):
+        """Resolve a bucket's regional client and split its keyspace into listing shards.
+
+        A single delimited listing at the start path returns the recordings stored
+        directly there plus the first-level prefixes, each of which becomes a shard
+        that is flat-listed on its own. With a path template the shards are the
+        recordings folders, found by walking the template on every scan so that new
+        class folders are listed right away; delta scans then list only the ones due.
+        """
+        # Get the bucket's region and its shared client
+        region = client_registry.region_for_bucket(bucket_name)
+        bucket_s3 = client_registry.client_for_region(region)
+
+        level = scan_template.level_of(start_path) if scan_template else None
+        if scan_template and level is None:
+            self.log(f"Start path {bucket_name}/{start_path} does not fit WASABI_SCAN_PATH_TEMPLATE; "
+                     f"nothing to scan", level=logging.WARNING)
+            return {'client': bucket_s3, 'region': region, 'recordings': [], 'shards': [], 'summary_folders': {}}
+        if scan_template and level < len(scan_template.levels):
+            shards, summary_folders = self._walk_template(bucket_s3, bucket_name, start_path, level)
+            return {'client': bucket_s3, 'region': region, 'recordings': [], 'shards': shards,
+                    'summary_folders': summary_folders}
+
+        self.log(f"Deep scanning path: {bucket_name}/{start_path}", level=logging.DEBUG)
+        recordings = []
+        shards = []
+        for page in self._list_pages(bucket_s3, 'plan', Bucket=bucket_name, Prefix=start_path, Delimiter='/'):
+            for obj in page.get('Contents', []):
+                if self._is_audio_file(obj['Key']):
+                    recordings.append(obj)
+            for prefix in page.get('CommonPrefixes', []):
+                shards.append(prefix['Prefix'])
+
+        return {'client': bucket_s3, 'region': region, 'recordings': recordings, 'shards': shards,
+                'summary_folders': {}}
+
+    def _walk_template(self, bucket_s3, bucket_name, start_path, level):
+        """Find the recordings folders below start_path that fit the path template.
+
+        Each level is one delimited listing per matching folder, so folders that cannot
+        hold recordings are never listed. The listing that shows a recordings folder
+        also shows its summaries folder, if any. Returns (shards, summary folders).
+        """
+        last = len(scan_template.levels) - 1
+        folders = [start_path]
+        shards = []
+        summary_folders = {}
+        with ThreadPoolExecutor(max_workers=self.scan_concurrency) as pool:
+            while folders and not self._abort_listing.is_set():
+                futures = {pool.submit(self._list_subfolders, bucket_s3, bucket_name, folder): folder
+                           for folder in folders}
+                folders = []
+                for future, parent in futures.items():
+                    try:
+                        subfolders = {prefix[len(parent):-1]: prefix for prefix in future.result()}
+                    except Exception as walk_error:
+                        self.log(f"Error scanning path '{parent}' in bucket '{bucket_name}': {str(walk_error)}",
+                                 level=logging.WARNING)
+                        continue
+                    # Walking a large template can take longer than the scan lease
+                    self._renew_scan_lease()
+                    matching = [prefix for name, prefix in sorted(subfolders.items())
+                                if scan_template.matches(level, name)]
+                    if level < last:
+                        folders.extend(matching)
+                        continue
+                    summaries = next((prefix for name, prefix in sorted(subfolders.items())
+                                      if name.lower() in SUMMARY_FOLDER_NAMES), None)
+                    for prefix in matching:
+                        shards.append(prefix)
+                        if summaries:
+                            summary_folders[prefix] = summaries
+                level += 1
+
+        self.log(f"Found {len(shards)} recordings folders in {bucket_name}/{start_path}", level=logging.DEBUG)
+        return shards, summary_folders
+
+    def _list_subfolders(self, bucket_s3, bucket_name, prefix):
+        """Folders directly below prefix, from a delimited listing"""
+        folders = []
+        for page in self._list_pages(bucket_s3, 'walk', Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+            folders.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+        return folders
+
+    def _list_pages(self, bucket_s3, kind, **kwargs):
+        """Paginate list_objects_v2, recording each call's latency and object count"""
+        pages = iter(bucket_s3.get_paginator('list_objects_v2').paginate(**kwargs))
+        while True:
+            started = time.perf_counter()
+            page = next(pages, None)
+            if page is None:
+                return
+            metrics.observe('wasabi_list_call_seconds', time.perf_counter() - started, kind=kind)
+            metrics.inc('wasabi_list_calls_total', kind=kind)
+            metrics.inc('wasabi_objects_scanned_total', len(page.get('Contents', [])))
+            yield page
+
+    def _list_shard(self, bucket_s3, bucket_name, prefix, pages):
+        """List every recording object below prefix with one non-delimited (flat) listing.
+
+        Each page's recordings are put on the pages queue as soon as the page arrives.
+        """
+        self.log(f"Deep scanning path: {bucket_name}/{prefix}", level=logging.DEBUG)
+        for page in self._list_pages(bucket_s3, 'shard', Bucket=bucket_name, Prefix=prefix):
+            if self._abort_listing.is_set():
+                raise RuntimeError("Listing cancelled")
+            recordings = [obj for obj in page.get('Contents', []) if self._is_audio_file(obj['Key'])]
+            while True:
+                try:
+                    pages.put((bucket_name, prefix, recordings), timeout=0.5)
+                    break
+                except queue.Full:
+                    if self._abort_listing.is_set():
+                        return
+
+    def _consume_listings(self, futures, pages, plans, full_buckets, now):
+        """Process listing pages until every shard listing has finished"""
+        diffs = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            self._flush_logs()
+            if self.cancelled:
+                # Listings still running stop at their next page; unfinished shards keep their old manifest
+                pending = {future for future in pending if not future.cancel()}
+                continue
+            # A listing queues all of its pages before its future completes
+            self._drain_pages(pages, plans, diffs, full_buckets)
+            for future in done:
+                bucket_name, shard = futures[future]
+                diff = diffs.pop((bucket_name, shard), None)
+                if future.cancelled():
+                    continue
+                try:
+                    future.result()
+                except Exception as scan_error:
+                    # Listing failed; keep the previous manifest entries for this shard
+                    self.log(f"Error scanning path '{shard}' in bucket '{bucket_name}': {str(scan_error)}", level=logging.WARNING)
+                    continue
+                if diff is None:
+                    diff = ManifestDiff(self.session, bucket_name, shard, self.work_queue)
+                plans[bucket_name]['deleted'] += diff.finish(plans[bucket_name]['states'], now)
+        self._flush_logs()
+
+    def _drain_pages(self, pages, plans, diffs, full_buckets):
+        """Diff queued listing pages against the manifest and surface their recordings"""
+        metrics.set_gauge('wasabi_queue_depth', pages.qsize(), queue='listing_pages')
+        while not self.cancelled:
+            try:
+                bucket_name, shard, objects = pages.get_nowait()
+            except queue.Empty:
+                return
+            diff = diffs.get((bucket_name, shard))
+            if diff is None:
+                diff = diffs[(bucket_name, shard)] = ManifestDiff(self.session, bucket_name, shard,
+                                                                  self.work_queue)
+            changed = diff.add_page(objects)
+            plans[bucket_name]['changed'] += len(changed)
+            # A full reconcile surfaces everything, a delta scan only what is new or changed
+            for obj in (objects if bucket_name in full_buckets else changed):
+                self._surface_recording(bucket_name, obj)
+            self._flush_surfaced()
+
+    def _surface_recording(self, bucket_name, obj):
+        """Count a listed recording and queue it for download with the next _flush_surfaced()"""
+        full_path = f"{bucket_name}/{obj['Key']}"
+        self.log(f"Found recording: {full_path}", level=logging.DEBUG)
+        metrics.inc('wasabi_recordings_found_total')
+        last_modified = obj.get('LastModified')
+        if last_modified is not None and last_modified.tzinfo is not None:
+            last_modified = last_modified.astimezone(timezone.utc).replace(tzinfo=None)
+        self._surfaced.append((full_path, obj.get('Size'), (obj.get('ETag') or '').strip('"'), last_modified))
+        self.found_count += 1
+
+    def _flush_surfaced(self):
+        """Add the recordings surfaced since the last flush to the persistent work queue"""
+        surfaced, self._surfaced = self._surfaced, []
+        if surfaced:
+            self.queued_count += self.work_queue.enqueue(surfaced)
+        self._renew_scan_lease()
+
+    def _renew_scan_lease(self):
+        """Keep this node's scan lease while it plans, walks and lists; safe to call from pool threads"""
+        if self._scan_lease and time.monotonic() - self._scan_lease_renewed_at > \
+                self.node_leases.duration.total_seconds() / 3:
+            self._scan_lease_renewed_at = time.monotonic()
+            if not self.node_leases.renew(self._scan_lease, NODE_ID):
+                self.log("Another node took over the scan; stopping this one", level=logging.WARNING)
+                self._abort_listing.set()
+
+    def _store_summary_folders(self, bucket_name, summary_folders):
+        """Remember the summaries folder found next to each recordings folder"""
+        if not summary_folders:
+            return
+        session = CoordSession()
+        try:
+            try:
+                self._store_summary_folder_rows(session, bucket_name, summary_folders)
+            except IntegrityError:
+                # Another node stored some of these meanwhile; look again
+                session.rollback()
+                self._store_summary_folder_rows(session, bucket_name, summary_folders)
+        finally:
+            session.close()
+
+    def _store_summary_folder_rows(self, session, bucket_name, summary_folders):
+        existing = {row.recordings_folder: row for row in
+                    session.query(SummaryFolder).filter_by(bucket=bucket_name)}
+        for recordings_prefix, summaries_prefix in summary_folders.items():
+            recordings_folder = f"{bucket_name}/{recordings_prefix.rstrip('/')}"
+            summaries_folder = f"{bucket_name}/{summaries_prefix.rstrip('/')}"
+            row = existing.get(recordings_folder)
+            if row is None:
+                session.add(SummaryFolder(bucket=bucket_name, recordings_folder=recordings_folder,
+                                          summaries_folder=summaries_folder))
+            elif row.summaries_folder != summaries_folder:
+                row.summaries_folder = summaries_folder
+        session.commit()
+
+    def _shard_is_due(self, state, now):
+        """Whether a delta scan has to list a shard: new, recently changed or not listed for a while"""
+        if state is None or state.last_listed_at is None:
+            return True
+        if state.last_changed_at and now - state.last_changed_at < SCAN_HOT_WINDOW:
+            return True
+        interval = SCAN_COLD_RELIST_INTERVAL
+        if state.high_water_mark is not None:
+            # New recordings go where recent ones went; a class quiet for months rarely gets one
+            quiet_for = now - state.high_water_mark
+            if quiet_for < SCAN_HOT_WINDOW:
+                return True
+            interval = min(max(interval, quiet_for * SCAN_QUIET_RELIST_FACTOR), FULL_RECONCILE_INTERVAL)
+        return now - state.last_listed_at >= interval
+
+    def _finish_reconcile(self, bucket_name, start_path, shards, states, now):
+        """Record a full reconcile and forget shards that no longer exist below the start path"""
+        current = set(shards)
+        # Shards are first-level folders, or deeper recordings folders with a path template
+        enclosing = {shard[:index + 1] for shard in shards
+                     for index in range(len(start_path), len(shard) - 1) if shard[index] == '/'}
+        for prefix, state in list(states.items()):
+            if prefix == start_path or not prefix.startswith(start_path) or prefix in current:
+                continue
+            # Manifest entries of a folder around or inside a current shard belong to that shard
+            inside = any(prefix[:index + 1] in current
+                         for index in range(len(start_path), len(prefix) - 1) if prefix[index] == '/')
+            if prefix not in enclosing and not inside:
+                self.session.query(ListingManifest).filter(
+                    ListingManifest.bucket == bucket_name,
+                    ListingManifest.key >= prefix,
+                    ListingManifest.key < prefix + MANIFEST_KEY_END).delete(synchronize_session=False)
+            self.session.delete(state)
+            del states[prefix]
+
+        root_state = states.get(start_path)
+        if root_state is None:
+            root_state = ScanState(bucket=bucket_name, prefix=start_path)
+            self.session.add(root_state)
+            states[start_path] = root_state
+        root_state.last_full_scan_at = now
+        self.session.commit()
+
+    def _pending_manifest_objects(self, bucket_name, start_path):
+        """Manifest entries below the start path that have no download record or work queue item yet, in chunks"""
+        downloaded = exists().where(and_(
+            ProcessedFile.file_path == ListingManifest.bucket + '/' + ListingManifest.key,
+            ProcessedFile.operation == 'download'))
+        query = self.session.query(ListingManifest).filter(
+            ListingManifest.bucket == bucket_name,
+            ListingManifest.key >= start_path,
+            ListingManifest.key < start_path + MANIFEST_KEY_END,
+            ~downloaded)
+        if not COORDINATED:
+            query = query.filter(~exists().where(and_(
+                WorkItem.path == ListingManifest.bucket + '/' + ListingManifest.key,
+                WorkItem.operation == 'download')))
+        rows = query.order_by(ListingManifest.key).yield_per(PROCESSED_LOOKUP_CHUNK)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == PROCESSED_LOOKUP_CHUNK:
+                yield from self._unqueued_manifest_objects(chunk)
+                chunk = []
+        yield from self._unqueued_manifest_objects(chunk)
+
+    def _unqueued_manifest_objects(self, rows):
+        """Listing objects for manifest rows; a shared queue lives in another database, so it is looked up per chunk"""
+        queued = self.work_queue.last_modified([row.bucket + '/' + row.key for row in rows]) if COORDINATED else {}
+        return [{'Key': row.key, 'Size': row.size, 'ETag': row.etag, 'LastModified': row.last_modified}
+                for row in rows if row.bucket + '/' + row.key not in queued]
+
+    def _download_files(self, s3):
+        try:
+            work_queue = self.work_queue
+            waiting = work_queue.counts().get('pending', 0)
+            if waiting:
+                self.log(f"{waiting} recordings are waiting in the download queue")
+
+            files_downloaded = 0
+            files_skipped = 0
+            files_taken = 0
+            local_paths = set()
+            progress = TransferProgress(self.log, 'Downloading')
+            max_in_flight = self.download_concurrency * 2
+            in_flight = {}
+            content_jobs = {}  # Content key -> job downloading it, for duplicates leased meanwhile
+            source_done = False
+            renewed_at = time.monotonic()
+            storage = LocalStorageManager(self.destination_path) if DISK_BUDGET > 0 else None
+            paused = False
+            paused_at = upload_requested_at = evicted_at = None
+
+            with ThreadPoolExecutor(max_workers=self.download_concurrency) as pool:
+                while not source_done or in_flight:
+                    if self.cancelled and not source_done:
+                        # Drop downloads that have not started; running ones stop after their current part
+                        source_done = True
+                        cancelled = [in_flight.pop(future) for future in list(in_flight) if future.cancel()]
+                        work_queue.release([item['id'] for job in cancelled
+                                            for item in [job['item']] + job['duplicates']], owner=NODE_ID)
+                        self.log("Download cancelled. Stopping downloads in progress after their current part...")
+                        continue
+
+                    # Over the disk budget, free space or pause until summaries are uploaded
+                    if storage is not None and not source_done and not storage.has_room():
+                        # Eviction looks up every local recording, so it runs at most once per rescan interval
+                        evicted_files = 0
+                        if evicted_at is None or time.monotonic() - evicted_at >= storage.rescan_interval:
+                            evicted_files, evicted_bytes = storage.evict(log=self.log)
+                            evicted_at = time.monotonic()
+                        if evicted_files:
+                            self.log(f"Removed {evicted_files} summarized recordings ({_format_bytes(evicted_bytes)}) "
+                                     f"to stay within the disk budget")
+                        if not storage.has_room():
+                            # Save finished downloads now; their summaries cannot be matched until then
+                            self._commit_processed()
+                            if not paused:
+                                self.log(f"Disk budget of {_format_bytes(storage.budget)} reached; downloads pause "
+                                         f"until summaries are uploaded and recordings can be removed",
+                                         level=logging.WARNING)
+                                paused = True
+                                paused_at = time.monotonic()
+                            if self.upload_requested and (upload_requested_at is None or time.monotonic()
+                                                          - upload_requested_at >= storage.rescan_interval):
+                                # Uploading the summaries written so far lets their recordings be removed
+                                self.upload_requested()
+                                upload_requested_at = time.monotonic()
+                            metrics.set_gauge('wasabi_downloads_paused', 1)
+                            if time.monotonic() - paused_at >= DISK_BUDGET_PAUSE_LIMIT:
+                                # Give the leases of downloads that have not started back and end this cycle
+                                source_done = True
+                                waiting = [in_flight.pop(future) for future in list(in_flight) if future.cancel()]
+                                work_queue.release([item['id'] for job in waiting
+                                                    for item in [job['item']] + job['duplicates']], owner=NODE_ID)
+                                metrics.set_gauge('wasabi_downloads_paused', 0)
+                                self.log(f"Disk budget still reached after {DISK_BUDGET_PAUSE_LIMIT:g} seconds; "
+                                         f"the remaining downloads wait for the next cycle", level=logging.WARNING)
+                                continue
+                            if not in_flight:
+                                self._cancel_event.wait(min(5, storage.rescan_interval))
+                                continue
+                    elif paused:
+                        self.log("Disk space is available again; downloads resume")
+                        paused = False
+                        metrics.set_gauge('wasabi_downloads_paused', 0)
+
+                    # Lease more recordings while there is room
+                    if not source_done and len(in_flight) < max_in_flight and not paused:
+                        room = max_in_flight - len(in_flight)
+                        if self.download_limit is not None:
+                            room = min(room, self.download_limit - files_taken)
+                        # Check the scan before leasing, so nothing it queued last is missed;
+                        # with a coordination database that includes scans running on other nodes
+                        scan_done = (self.scan_finished is None or self.scan_finished.is_set()) and not (
+                            COORDINATED and self.scan_finished is not None and self.node_leases.active('scan:'))
+                        items = work_queue.lease(NODE_ID, room)
+                        files_taken += len(items)
+                        if room <= 0 or (not items and scan_done):
+                            source_done = True
+                        duplicates_before = self.duplicate_count
+                        jobs, skipped, recorded = self._prepare_download_jobs(items, local_paths, content_jobs)
+                        files_skipped += len(skipped) + len(recorded) - (self.duplicate_count - duplicates_before)
+                        # Skips with nothing to save are done now; the rest once their records are committed
+                        work_queue.complete(skipped, owner=NODE_ID)
+                        self._completed_items.extend(recorded)
+                        for job in jobs:
+                            if job['size'] is not None:
+                                progress.add_file(job['path'], job['size'])
+                            if storage is not None:
+                                storage.reserve(job['size'])
+                            in_flight[pool.submit(self._download_one, s3, job, progress)] = job
+                        if not items and not in_flight and not source_done:
+                            # Wait for the scan to queue more
+                            self._cancel_event.wait(0.2)
+
+                    # Keep the leases of long downloads from expiring
+                    if time.monotonic() - renewed_at > work_queue.lease_duration.total_seconds() / 3:
+                        # Duplicates are held until their original's download finishes, finished
+                        # items until their download records are committed
+                        work_queue.renew(NODE_ID, [item_id for job in in_flight.values()
+                                                   for item_id in [job['item']['id']]
+                                                   + [duplicate['id'] for duplicate in job['duplicates']]]
+                                         + self._completed_items)
+                        renewed_at = time.monotonic()
+
+                    if not in_flight:
+                        self._flush_logs()
+                        continue
+                    done, _ = wait(in_flight, timeout=0.2, return_when=FIRST_COMPLETED)
+                    self._flush_logs()
+                    for future in done:
+                        job = in_flight.pop(future)
+                        if content_jobs.get(job['content_key']) is job:
+                            del content_jobs[job['content_key']]
+                        try:
+                            future.result()
+                        except Exception as download_error:
+                            # Duplicates waiting for this download get their own attempt
+                            work_queue.release([item['id'] for item in job['duplicates']], owner=NODE_ID)
+                            if self.cancelled:
+                                work_queue.release([job['item']['id']], owner=NODE_ID)
+                                continue
+                            state = work_queue.fail(job['item'], download_error, owner=NODE_ID)
+                            retry_note = " (giving up)" if state == 'failed' else " (will retry)"
+                            self.log(f"Failed to download {job['path']}: {str(download_error)}{retry_note}",
+                                     level=logging.WARNING)
+                            metrics.inc('wasabi_transfer_failures_total', operation='download')
+                            continue
+                        metrics.inc('wasabi_files_downloaded_total')
+                        metrics.observe('wasabi_object_seconds', time.perf_counter() - job['started'],
+                                        operation='download')
+
+                        # Record successful download with original path and local filename
+                        self.log(f"Successfully downloaded: {job['path']} as {job['safe_filename']}")
+                        downloaded = self._record_processed(
+                            job['path'],  # Original Wasabi path
+                            'download',
+                            self._dedup_downloaded(job),  # Store filename without extension
+                            content_key=job['content_key'],
+                            content_hash=job.get('content_hash')
+                        )
+                        self._completed_items.append(job['item']['id'])
+                        for item in job['duplicates']:
+                            self._record_duplicate(item['path'], downloaded, job['content_key'])
+                            self._completed_items.append(item['id'])
+                        files_downloaded += 1
 
-# Create database engine and tables
-engine = create_engine('sqlite:///processed_files.db')
-# Only create tables if they don't exist
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
+            if paused:
+                metrics.set_gauge('wasabi_downloads_paused', 0)
+            self._commit_processed()
+            duplicates = f", {self.duplicate_count} duplicates of recordings already downloaded" \
+                if self.duplicate_count else ""
+            self.log(f"Download complete. Downloaded {files_downloaded} files "
+                     f"({_format_bytes(progress.transferred_bytes)}), skipped {files_skipped} files{duplicates}.")
 
-class WasabiWorker:
-    def __init__(self, operation, source_path=None, destination_path=None, start_path=None):
-        self.operation = operation
-        self.source_path = source_path
-        self.destination_path = destination_path
-        self.start_path = start_path
-        self.session = Session()
-        self.found_recordings = []
-        self.progress_callback = None
-        self.finished_callback = None
-        self.error_callback = None
+        except Exception as e:
+            self.log(f"Error in download process: {str(e)}", level=logging.WARNING)
 
-    def set_callbacks(self, progress_cb, finished_cb, error_cb):
-        self.progress_callback = progress_cb
-        self.finished_callback = finished_cb
-        self.error_callback = error_cb
+    def _prepare_download_jobs(self, items, local_paths, content_jobs):
+        """Filter out leased recordings that are already downloaded; returns (jobs, skipped, recorded).
 
-    def log(self, message):
-        if self.progress_callback:
-            self.progress_callback(message)
+        skipped are the IDs of items with nothing left to do, recorded those of items that were
+        recorded instead of downloaded and are done once the records are committed. Recordings
+        whose content is being downloaded by a job in content_jobs are attached to that job's
+        duplicates instead.
+        """
+        jobs = []
+        skipped = []
+        recorded = []
+        audio_items = []
+        for item in items:
+            (audio_items if self._is_audio_file(item['path']) else skipped).append(item)
+        skipped = [item['id'] for item in skipped]
 
-    def error(self, message):
-        if self.error_callback:
-            self.error_callback(message)
+        # Look up the download records of the whole batch at once
+        already_downloaded = self._processed_paths([item['path'] for item in audio_items], 'download')
+        same_content = {}
+        if DEDUP_CONTENT:
+            same_content, _ = self._downloads_by_content(
+                [_content_key(item['etag'], item['size']) for item in audio_items])
 
-    def start(self):
+        for item in audio_items:
+            path = item['path']
+            # Check if file already processed in database
+            if path in already_downloaded:
+                self.log(f"Skipping {path} - already in database", level=logging.DEBUG)
+                skipped.append(item['id'])
+                continue
+
+            # Split path into bucket and key
+            parts = path.split('/')
+            bucket_name = parts[0]
+            object_key = '/'.join(parts[1:])
+
+            # Create a safe filename from the path
+            safe_filename = object_key.replace('/', '_')
+            local_path = os.path.join(self.destination_path, safe_filename)
+
+            # If a complete file already exists with this name, skip it and record in database
+            expected_size = item['size']
+            content_key = _content_key(item['etag'], expected_size)
+            if os.path.exists(local_path) and expected_size is not None \
+                    and os.path.getsize(local_path) != expected_size:
+                # A truncated file left by an older, non-atomic download; it is replaced once complete
+                self.log(f"{safe_filename} is incomplete ({_format_bytes(os.path.getsize(local_path))} of "
+                         f"{_format_bytes(expected_size)}), downloading it again")
+            elif os.path.exists(local_path):
+                self.log(f"Skipping {path} - file already exists locally")
+
+                # Record in database to prevent future attempts
+                row = self._record_processed(
+                    path,  # Original Wasabi path
+                    'download',
+                    os.path.splitext(safe_filename)[0],  # Store filename without extension
+                    content_key=content_key
+                )
+                already_downloaded.add(path)
+                if content_key:
+                    same_content.setdefault(content_key, []).append(row)
+
+                recorded.append(item['id'])
+                continue
+
+            # The same recording is often uploaded to several classes; fetch its content once
+            if DEDUP_CONTENT and content_key:
+                original = next((row for row in same_content.get(content_key, []) if row.local_timestamp), None)
+                if original is not None:
+                    self._record_duplicate(path, original, content_key)
+                    already_downloaded.add(path)
+                    recorded.append(item['id'])
+                    continue
+                if content_key in content_jobs:
+                    content_jobs[content_key]['duplicates'].append(item)
+                    continue
+
+            # Two recordings can map to the same local file; fetch only the first
+            if local_path in local_paths:
+                self.log(f"Skipping {path} - {safe_filename} is already being downloaded", level=logging.DEBUG)
+                skipped.append(item['id'])
+                continue
+            local_paths.add(local_path)
+
+            # Ensure download directory exists
+            os.makedirs(self.destination_path, exist_ok=True)
+
+            jobs.append({
+                'item': item,
+                'path': path,
+                'bucket': bucket_name,
+                'key': object_key,
+                'safe_filename': safe_filename,
+                'local_path': local_path,
+                'size': expected_size,
+                'etag': item['etag'],
+                'content_key': content_key,
+                'duplicates': [],  # Items with the same content, recorded once this job succeeds
+            })
+            if DEDUP_CONTENT and content_key:
+                content_jobs[content_key] = jobs[-1]
+        return jobs, skipped, recorded
+
+    def _local_file_for(self, row):
+        """Local file of a download record, or its transcoded version once the original is replaced"""
+        local_path = os.path.join(self.destination_path, row.local_timestamp + os.path.splitext(row.file_path)[1])
+        transcoded_path = os.path.join(self.destination_path, row.local_timestamp + TRANSCODE_EXTENSION)
+        if not os.path.exists(local_path) and os.path.exists(transcoded_path):
+            return transcoded_path
+        return local_path
+
+    def _record_duplicate(self, path, original, content_key):
+        """Record a recording whose content was already downloaded for original instead of downloading it.
+
+        The record points at original's local file, so the summary made for that file is
+        uploaded for both; with WASABI_DEDUP_HARDLINKS the file is also linked under path's name.
+        """
+        local_name = original.local_timestamp
+        if DEDUP_HARDLINKS:
+            link_name = path.split('/', 1)[1].replace('/', '_')
+            try:
+                os.link(self._local_file_for(original), os.path.join(self.destination_path, link_name))
+                local_name = os.path.splitext(link_name)[0]
+            except OSError as link_error:
+                self.log(f"Could not link {link_name} to {original.local_timestamp}, "
+                         f"referencing it instead: {str(link_error)}", level=logging.DEBUG)
+        self._record_processed(path, 'download', local_name, content_key=content_key,
+                               content_hash=getattr(original, 'content_hash', None))
+        self.duplicate_count += 1
+        metrics.inc('wasabi_duplicates_total')
+        self.log(f"Skipping {path} - same content as {original.file_path}")
+
+    def _dedup_downloaded(self, job):
+        """Return the local name to record for a finished download.
+
+        A multipart recording whose hash matches an earlier download is dropped again (or,
+        with WASABI_DEDUP_HARDLINKS, replaced by a link) and the earlier file is referenced.
+        """
+        local_name = os.path.splitext(job['safe_filename'])[0]
+        if not job.get('content_hash'):
+            return local_name
+        _, by_hash = self._downloads_by_content(content_hashes=[job['content_hash']])
+        original = next((row for row in by_hash.get(job['content_hash'], [])
+                         if row.file_path != job['path'] and row.local_timestamp), None)
+        if original is None:
+            return local_name
         try:
-            # Initialize Wasabi client
-            s3 = boto3.client(
-                's3',
-                endpoint_url='https://s3.us-east-1.wasabisys.com',
-                aws_access_key_id=os.getenv('WASABI_ACCESS_KEY'),
-                aws_secret_access_key=os.getenv('WASABI_SECRET_KEY'),
-                region_name='us-east-1'
-            )
+            if DEDUP_HARDLINKS:
+                temp_path = job['local_path'] + '.link'
+                os.link(self._local_file_for(original), temp_path)
+                os.replace(temp_path, job['local_path'])
+            else:
+                os.remove(job['local_path'])
+                local_name = original.local_timestamp
+        except OSError as link_error:
+            self.log(f"Keeping {job['safe_filename']}: {str(link_error)}", level=logging.DEBUG)
+            return local_name
+        self.duplicate_count += 1
+        metrics.inc('wasabi_duplicates_total')
+        self.log(f"{job['path']} has the same content as {original.file_path}; keeping one copy")
+        return local_name
 
-            if self.operation == 'scan':
-                self._scan_wasabi(s3)
-            elif self.operation == 'download':
-                self._download_files(s3)
-            elif self.operation == 'upload':
-                self._upload_files(s3)
+    def _download_one(self, s3, job, progress):
+        """Download a single recording on a pool thread using multipart ranged GETs"""
+        job['started'] = time.perf_counter()
+        bucket_name = job['bucket']
+        object_key = job['key']
 
-        except Exception as e:
-            self.error(str(e))
-        finally:
-            self.session.close()
-            if self.finished_callback:
-                self.finished_callback()
+        # Get the shared client for the bucket's region
+        try:
+            bucket_s3 = client_registry.client_for_bucket(bucket_name)
+        except Exception as region_error:
+            self.log(f"Error getting region for bucket {bucket_name}, using default: {str(region_error)}")
+            bucket_s3 = s3  # Use default client if region-specific fails
 
-    def _is_audio_file(self, filename):
-        """Check if the file is an audio file based on extension."""
-        audio_extensions = {'.mp3', '.wav', '.ogg', '.m4a', '.aac', '.wma', '.flac', '.alac', '.aiff'}
-        return any(filename.lower().endswith(ext) for ext in audio_extensions)
+        # Size and ETag pin the object version every part is fetched from
+        if job['size'] is None or not job['etag']:
+            head = bucket_s3.head_object(Bucket=bucket_name, Key=object_key)
+            job['size'] = head['ContentLength']
+            job['etag'] = head['ETag'].strip('"')
+            progress.add_file(job['path'], job['size'])
 
-    def _get_summary_path(self, path):
-        """Convert a recording path to its corresponding summary path"""
-        # Split the path into parts
-        path_parts = path.split('/')
-        
-        # Replace the last folder with 'summaries'
-        if len(path_parts) > 1:
-            path_parts[-2] = 'summaries'
-        else:
-            path_parts.insert(-1, 'summaries')
-            
-        # Add _summary to the filename and change extension to .pdf
-        if '.' in path_parts[-1]:
-            base_name = os.path.splitext(path_parts[-1])[0]
-            path_parts[-1] = f"{base_name}_summary.pdf"
-            
-        return '/'.join(path_parts)
+        # Try downloading with region-specific client first; a retry resumes from the parts on disk
+        try:
+            self._resumable_download(bucket_s3, job).run(progress.callback(job['path']),
+                                                         should_stop=lambda: self.cancelled)
+        except ObjectChangedError:
+            raise
+        except Exception as download_error:
+            if bucket_s3 != s3 and not self.cancelled:  # If using region-specific client failed, try with default
+                self.log(f"Region-specific download failed, trying with default client: {str(download_error)}")
+                client_registry.invalidate(bucket_name)
+                progress.restart(job['path'])
+                self._resumable_download(s3, job).run(progress.callback(job['path']),
+                                                      should_stop=lambda: self.cancelled)
+            else:
+                raise  # Re-raise the error if we're already using the default client
 
-    def _scan_wasabi(self, s3):
+        # The same multipart ETag needs the same part size, so those duplicates are found by hash
+        if DEDUP_CONTENT and DEDUP_HASH_MULTIPART and not _is_md5_etag(job['etag']):
+            job['content_hash'] = _file_sha256(job['local_path'])
+
+    def _resumable_download(self, s3, job):
+        return ResumableDownload(s3, job['bucket'], job['key'], job['local_path'], job['size'], job['etag'],
+                                 log=self.log)
+
+    def _transcode_candidates(self, known):
+        """(file name, Wasabi path) of downloaded recordings that are not in the speech profile yet.
+
+        Files whose download is not recorded yet are left for a later call, so every
+        transcoded file can be mapped back to its Wasabi path.
+        """
         try:
-            # First try to list buckets
-            try:
-                buckets = s3.list_buckets()
-                total_buckets = len(buckets['Buckets'])
-                self.log(f"Found {total_buckets} buckets. Starting scan...")
-                
-                self.found_recordings = []
-                buckets_scanned = 0
-                
-                # Try to scan each bucket
-                for bucket in buckets['Buckets']:
-                    bucket_name = bucket['Name']
-                    buckets_scanned += 1
-                    self.log(f"Scanning bucket {buckets_scanned}/{total_buckets}: {bucket_name}")
-                    
-                    try:
-                        # Get the bucket's region
-                        bucket_location = s3.get_bucket_location(Bucket=bucket_name)
-                        region = bucket_location['LocationConstraint'] or 'us-east-1'  # None means us-east-1
-                        
-                        # Create a new client for this specific region
-                        bucket_s3 = boto3.client(
-                            's3',
-                            endpoint_url=f'https://s3.{region}.wasabisys.com',
-                            aws_access_key_id=os.getenv('WASABI_ACCESS_KEY'),
-                            aws_secret_access_key=os.getenv('WASABI_SECRET_KEY'),
-                            region_name=region
-                        )
-                        
-                        def scan_path_recursive(current_path):
-                            """Recursively scan a path and all its subdirectories"""
-                            try:
-                                self.log(f"Deep scanning path: {current_path}")
-                                
-                                # Get all objects in current path
-                                paginator = bucket_s3.get_paginator('list_objects_v2')
-                                operation_parameters = {
-                                    'Bucket': bucket_name,
-                                    'Prefix': current_path,
-                                    'Delimiter': '/'
-                                }
-                                
-                                # First, check for recordings in current path
-                                for page in paginator.paginate(**operation_parameters):
-                                    if 'Contents' in page:
-                                        for obj in page['Contents']:
-                                            path = obj['Key']
-                                            if self._is_audio_file(path):
-                                                full_path = f"{bucket_name}/{path}"
-                                                self.log(f"Found recording: {full_path}")
-                                                # Add to found recordings instead of downloading immediately
-                                                self.found_recordings.append(full_path)
-                                
-                                # Then, recursively scan all subdirectories
-                                for page in paginator.paginate(**operation_parameters):
-                                    if 'CommonPrefixes' in page:
-                                        for prefix in page['CommonPrefixes']:
-                                            subdir = prefix['Prefix']
-                                            # Recursively scan this subdirectory
-                                            scan_path_recursive(subdir)
-                                            
-                            except Exception as scan_error:
-                                self.log(f"Error scanning path '{current_path}': {str(scan_error)}")
-                        
-                        # Start recursive scan from the specified path
-                        if self.start_path:
-                            start_path = self.start_path.strip()
-                            if not start_path.endswith('/'):
-                                start_path += '/'
-                            scan_path_recursive(start_path)
-                        else:
-                            scan_path_recursive('')  # Start from root
-                        
-                        self.log(f"Completed deep scan of bucket '{bucket_name}' in region {region}")
-                        
-                    except Exception as bucket_error:
-                        self.log(f"Error accessing bucket '{bucket_name}': {str(bucket_error)}")
-                        continue
-                
-                summary = f"Deep scan complete. Scanned {buckets_scanned} buckets."
-                self.log(summary)
-                
-            except Exception as e:
-                self.error(f"Failed to list buckets. Error: {str(e)}")
-                return
+            names = sorted(os.listdir(self.destination_path))
+        except FileNotFoundError:
+            return []
+        names = [name for name in names
+                 if name not in known and self._is_audio_file(name)
+                 and not name.lower().endswith(TRANSCODE_EXTENSION.lower())]
+        base_names = {os.path.splitext(name)[0] for name in names}
 
-        except Exception as e:
-            self.error(f"Error during Wasabi scan: {str(e)}")
+        # Downloads of the concurrent download stage first, then those already committed
+        paths = {}
+        if self.downloaded_paths is not None:
+            paths.update((base_name, self.downloaded_paths[base_name])
+                         for base_name in base_names if base_name in self.downloaded_paths)
+        missing = list(base_names - paths.keys())
+        session = Session()  # A short session sees rows the download stage committed meanwhile
+        try:
+            for start in range(0, len(missing), PROCESSED_LOOKUP_CHUNK):
+                rows = session.query(ProcessedFile.local_timestamp, ProcessedFile.file_path).filter(
+                    ProcessedFile.operation == 'download',
+                    ProcessedFile.local_timestamp.in_(missing[start:start + PROCESSED_LOOKUP_CHUNK])
+                ).order_by(ProcessedFile.id)
+                for row in rows:
+                    paths.setdefault(row.local_timestamp, row.file_path)
+        finally:
+            session.close()
+        return [(name, paths[os.path.splitext(name)[0]]) for name in names if os.path.splitext(name)[0] in paths]
 
-    def _download_files(self, s3):
+    def _transcode_files(self):
+        """Convert downloaded recordings to the speech profile in a process pool.
+
+        Runs next to a download stage and picks up each recording as soon as it has its
+        final name, until download_finished is set. Each result is recorded in the
+        transcoded_files table with the recording's Wasabi path; the summary keeps
+        the original's base name, so it still finds its way back on upload.
+        """
         try:
-            files_downloaded = 0
-            files_skipped = 0
-            
-            for path in self.found_recordings:
-                if self._is_audio_file(path):
-                    # Check if file already processed in database
-                    if self.session.query(ProcessedFile).filter_by(
-                        file_path=path, operation='download').first():
-                        self.log(f"Skipping {path} - already in database")
-                        files_skipped += 1
+            ffmpeg = shutil.which(FFMPEG)
+            if not ffmpeg:
+                self.log(f"Transcoding is enabled but {FFMPEG} was not found; recordings are kept as downloaded",
+                         level=logging.WARNING)
+                return
+
+            # Files handled by earlier runs, including failures, are not tried again
+            known = {row.source_file for row in self.session.query(TranscodedFile.source_file)}
+            in_flight = {}
+            source_done = False
+            files_transcoded = 0
+            bytes_in = bytes_out = 0
+
+            with ProcessPoolExecutor(max_workers=self.transcode_concurrency) as pool:
+                while not source_done or in_flight:
+                    if self.cancelled and not source_done:
+                        source_done = True
+                        for future in [future for future in in_flight if future.cancel()]:
+                            del in_flight[future]
+                        self.log("Transcoding cancelled. Finishing the files already being converted...")
                         continue
 
-                    try:
-                        # Split path into bucket and key
-                        parts = path.split('/')
-                        bucket_name = parts[0]
-                        object_key = '/'.join(parts[1:])
-                        
-                        # Create a safe filename from the path
-                        safe_filename = object_key.replace('/', '_')
-                        local_path = os.path.join(self.destination_path, safe_filename)
-
-                        # If file already exists with this name, skip it and record in database
-                        if os.path.exists(local_path):
-                            self.log(f"Skipping {path} - file already exists locally")
-                            
-                            # Record in database to prevent future attempts
-                            processed_file = ProcessedFile(
-                                file_path=path,  # Original Wasabi path
-                                operation='download',
-                                local_timestamp=os.path.splitext(safe_filename)[0]  # Store filename without extension
-                            )
-                            self.session.add(processed_file)
-                            self.session.commit()
-                            
-                            files_skipped += 1
+                    if not source_done:
+                        # Check the download before listing, so nothing it finished last is missed
+                        download_done = self.download_finished is None or self.download_finished.is_set()
+                        candidates = self._transcode_candidates(known)
+                        for name, file_path in candidates:
+                            known.add(name)
+                            output_file = os.path.splitext(name)[0] + TRANSCODE_EXTENSION
+                            future = pool.submit(_transcode_file, ffmpeg, os.path.join(self.destination_path, name),
+                                                 os.path.join(self.destination_path, output_file))
+                            in_flight[future] = (name, file_path, output_file, time.perf_counter())
+                        metrics.set_gauge('wasabi_queue_depth', len(in_flight), queue='transcode')
+                        if download_done and not candidates:
+                            source_done = True
+                        elif not in_flight:
+                            # Wait for the download to finish more recordings
+                            self._cancel_event.wait(1)
                             continue
 
-                        # Get the bucket's region
+                    if not in_flight:
+                        continue
+                    done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                    self._flush_logs()
+                    for future in done:
+                        name, file_path, output_file, started = in_flight.pop(future)
+                        source_path = os.path.join(self.destination_path, name)
                         try:
-                            bucket_location = s3.get_bucket_location(Bucket=bucket_name)
-                            region = bucket_location['LocationConstraint'] or 'us-east-1'  # None means us-east-1
-                            
-                            # Create a new client for this specific region
-                            bucket_s3 = boto3.client(
-                                's3',
-                                endpoint_url=f'https://s3.{region}.wasabisys.com',
-                                aws_access_key_id=os.getenv('WASABI_ACCESS_KEY'),
-                                aws_secret_access_key=os.getenv('WASABI_SECRET_KEY'),
-                                region_name=region
-                            )
-                        except Exception as region_error:
-                            self.log(f"Error getting region for bucket {bucket_name}, using default: {str(region_error)}")
-                            bucket_s3 = s3  # Use default client if region-specific fails
-
-                        # Ensure download directory exists
-                        os.makedirs(self.destination_path, exist_ok=True)
-                        
-                        # Try downloading with region-specific client first
+                            source_size = os.path.getsize(source_path)
+                        except OSError as size_error:
+                            # E.g. removed meanwhile to stay within the disk budget
+                            self.log(f"Could not read {name} after transcoding: {str(size_error)}", level=logging.WARNING)
+                            continue
+                        record = TranscodedFile(source_file=name, file_path=file_path, source_size=source_size)
                         try:
-                            bucket_s3.download_file(bucket_name, object_key, local_path)
-                        except Exception as download_error:
-                            if bucket_s3 != s3:  # If using region-specific client failed, try with default
-                                self.log(f"Region-specific download failed, trying with default client: {str(download_error)}")
-                                s3.download_file(bucket_name, object_key, local_path)
-                            else:
-                                raise  # Re-raise the error if we're already using the default client
-                        
-                        # Record successful download with original path and local filename
-                        processed_file = ProcessedFile(
-                            file_path=path,  # Original Wasabi path
-                            operation='download',
-                            local_timestamp=os.path.splitext(safe_filename)[0]  # Store filename without extension
-                        )
-                        self.session.add(processed_file)
+                            record.output_size = future.result()
+                            record.output_file = output_file
+                        except Exception as transcode_error:
+                            record.error = str(transcode_error)[:500]
+                            self.log(f"Failed to transcode {name}: {str(transcode_error)}", level=logging.WARNING)
+                            metrics.inc('wasabi_transfer_failures_total', operation='transcode')
+                        self.session.add(record)
                         self.session.commit()
-                        
-                        self.log(f"Successfully downloaded: {path} as {safe_filename}")
-                        files_downloaded += 1
-                        
-                    except Exception as download_error:
-                        self.log(f"Failed to download {path}: {str(download_error)}")
-                    
-            self.log(f"Download complete. Downloaded {files_downloaded} files, skipped {files_skipped} files.")
-                    
+                        if record.output_file is None:
+                            continue
+
+                        if not TRANSCODE_KEEP_ORIGINAL:
+                            try:
+                                os.remove(source_path)
+                            except OSError as remove_error:
+                                self.log(f"Could not remove {name} after transcoding: {str(remove_error)}",
+                                         level=logging.WARNING)
+                        files_transcoded += 1
+                        bytes_in += record.source_size
+                        bytes_out += record.output_size
+                        metrics.inc('wasabi_files_transcoded_total')
+                        metrics.inc('wasabi_transcode_bytes_total', record.source_size, direction='in')
+                        metrics.inc('wasabi_transcode_bytes_total', record.output_size, direction='out')
+                        metrics.observe('wasabi_object_seconds', time.perf_counter() - started, operation='transcode')
+                        self.log(f"Transcoded {name} to {output_file} ({_format_bytes(record.source_size)} -> "
+                                 f"{_format_bytes(record.output_size)})", level=logging.DEBUG)
+
+            if files_transcoded:
+                self.log(f"Transcoding complete. Converted {files_transcoded} recordings from "
+                         f"{_format_bytes(bytes_in)} to {_format_bytes(bytes_out)}.")
+
         except Exception as e:
-            self.log(f"Error in download process: {str(e)}")
+            self.log(f"Error in transcode process: {str(e)}", level=logging.WARNING)
 
     def _upload_files(self, s3):
         try:
-            # Get list of PDF files in the source directory
-            pdf_files = [f for f in os.listdir(self.source_path) if f.endswith('.pdf')]
+            # Get list of PDF files in the source directory (or only the ones we were handed)
+            if self.specific_files is not None:
+                pdf_files = [f for f in self.specific_files if f.endswith('.pdf')]
+            else:
+                pdf_files = [f for f in os.listdir(self.source_path) if f.endswith('.pdf')]
             
             if pdf_files:
                 self.log(f"Found {len(pdf_files)} PDF files to process")
             
-            # Get all downloaded files from database for matching
-            downloaded_files = self.session.query(ProcessedFile).filter_by(
-                operation='download'
-            ).all()
-            
+            # Look up the downloads matching every PDF's file ID through the file_id index
+            downloads = downloads_by_file_id(
+                self.session, [os.path.splitext(pdf_file)[0].split('_')[-1] for pdf_file in pdf_files])
+
+            matched = []
             for pdf_file in pdf_files:
                 try:
                     # Get the base name without .pdf extension
@@ -312,83 +2865,618 @@ class WasabiWorker:
                         # Get the file ID (last component)
                         file_id = path_components[-1]
                         
-                        # Find matching audio file by checking if file ID is in the path
+                        # Find the matching audio file, preferring the one downloaded under this exact name
                         original_path = None
-                        for downloaded_file in downloaded_files:
-                            if file_id in downloaded_file.file_path:
+                        matches = downloads.get(file_id, [])
+                        for downloaded_file in matches:
+                            if downloaded_file.local_timestamp == base_name:
                                 original_path = downloaded_file
                                 break
+                        if original_path is None and matches:
+                            original_path = matches[0]
                         
                         if original_path:
-                            # Convert to summary path
-                            summary_path = self._get_summary_path(original_path.file_path)
-                            
-                            # Check if summary already uploaded
-                            if self.session.query(ProcessedFile).filter_by(
-                                file_path=summary_path, operation='upload').first():
-                                self.log(f"Skipping {summary_path} - already uploaded")
-                                continue
-                            
-                            # Get bucket and key
-                            parts = summary_path.split('/')
-                            bucket_name = parts[0]
-                            object_key = '/'.join(parts[1:])
-                            
-                            # Get the bucket's region
-                            try:
-                                bucket_location = s3.get_bucket_location(Bucket=bucket_name)
-                                region = bucket_location['LocationConstraint'] or 'us-east-1'
-                                
-                                # Create a new client for this specific region
-                                bucket_s3 = boto3.client(
-                                    's3',
-                                    endpoint_url=f'https://s3.{region}.wasabisys.com',
-                                    aws_access_key_id=os.getenv('WASABI_ACCESS_KEY'),
-                                    aws_secret_access_key=os.getenv('WASABI_SECRET_KEY'),
-                                    region_name=region
-                                )
-                            except Exception as region_error:
-                                self.log(f"Error getting region for bucket {bucket_name}, using default: {str(region_error)}")
-                                bucket_s3 = s3
-                            
-                            # Upload the PDF file
-                            local_path = os.path.join(self.source_path, pdf_file)
-                            try:
-                                bucket_s3.upload_file(
-                                    local_path, 
-                                    bucket_name, 
-                                    object_key,
-                                    ExtraArgs={'ACL': 'public-read'}
-                                )
-                                
-                                # Record successful upload
-                                processed_file = ProcessedFile(
-                                    file_path=summary_path,
-                                    operation='upload',
-                                    local_timestamp=base_name
-                                )
-                                self.session.add(processed_file)
-                                self.session.commit()
-                                
-                                self.log(f"Successfully uploaded summary: {summary_path}")
-                                
-                            except Exception as upload_error:
-                                if bucket_s3 != s3:
-                                    self.log(f"Region-specific upload failed, trying with default client: {str(upload_error)}")
-                                    s3.upload_file(local_path, bucket_name, object_key)
-                                else:
-                                    raise
+                            matched.append((pdf_file, base_name, original_path))
                         else:
                             # Log the attempted match for debugging
-                            self.log(f"No matching audio file found for {pdf_file} (ID: {file_id})")
+                            self.log(f"No matching audio file found for {pdf_file} (ID: {file_id})", level=logging.WARNING)
                     else:
                         self.log(f"Invalid filename format for {pdf_file}. Expected format: path_components_filename.pdf")
                         
                 except Exception as upload_error:
-                    self.log(f"Failed to upload {pdf_file}: {str(upload_error)}")
+                    self.log(f"Failed to upload {pdf_file}: {str(upload_error)}", level=logging.WARNING)
+
+            # A summary also belongs to every recording with the same content
+            by_key, by_hash = downloads_by_content(self.session, [row.content_key for _, _, row in matched],
+                                                   [row.content_hash for _, _, row in matched])
+            fan_out = []
+            for pdf_file, base_name, original_path in matched:
+                recordings = {original_path.file_path: original_path}
+                for row in by_key.get(original_path.content_key, []) + by_hash.get(original_path.content_hash, []):
+                    recordings.setdefault(row.file_path, row)
+                fan_out.append((pdf_file, base_name, recordings))
+            summary_folders = summary_folders_for([path for _, _, recordings in fan_out for path in recordings])
+            candidates = []
+            for pdf_file, base_name, recordings in fan_out:
+                if len(recordings) > 1:
+                    self.log(f"{pdf_file} is the summary of {len(recordings)} recordings with the same content",
+                             level=logging.DEBUG)
+                for recording_path in recordings:
+                    # Convert to summary path
+                    summary_path = self._get_summary_path(recording_path, summary_folders)
+
+                    # Get bucket and key
+                    parts = summary_path.split('/')
+                    candidates.append({
+                        'pdf_file': pdf_file,
+                        'base_name': base_name,
+                        'recording_path': recording_path,
+                        'summary_path': summary_path,
+                        'bucket': parts[0],
+                        'key': '/'.join(parts[1:]),
+                        'local_path': os.path.join(self.source_path, pdf_file),
+                    })
+
+            # Check every summary's upload record at once (and drop repeats within this batch)
+            already_uploaded = self._processed_paths([job['summary_path'] for job in candidates], 'upload')
+            jobs = []
+            for job in candidates:
+                if job['summary_path'] in already_uploaded:
+                    self.log(f"Skipping {job['summary_path']} - already uploaded", level=logging.DEBUG)
+                    continue
+                already_uploaded.add(job['summary_path'])
+                jobs.append(job)
+
+            # Summaries of fresh recordings and those with an SLA go first, taking turns between schools
+            recorded_at = self.work_queue.last_modified([job['recording_path'] for job in jobs])
+            jobs = self.work_queue.policy.order(jobs, path=lambda job: job['recording_path'],
+                                                last_modified=lambda job: recorded_at.get(job['recording_path']))
+
+            if jobs:
+                self.log(f"Uploading {len(jobs)} summaries with {self.upload_concurrency} workers...")
+
+            progress = TransferProgress(self.log, 'Uploading')
+            files_uploaded = 0
+            with ThreadPoolExecutor(max_workers=self.upload_concurrency) as pool:
+                futures = {pool.submit(self._upload_one, s3, job, progress): job for job in jobs}
+                for future in self._iter_completed(futures):
+                    job = futures[future]
+                    try:
+                        future.result()
+                    except Exception as upload_error:
+                        self.log(f"Failed to upload {job['pdf_file']}: {str(upload_error)}", level=logging.WARNING)
+                        metrics.inc('wasabi_transfer_failures_total', operation='upload')
+                        continue
+                    metrics.inc('wasabi_files_uploaded_total')
+                    metrics.inc('wasabi_bytes_uploaded_total', job['size'])
+                    metrics.observe('wasabi_object_seconds', time.perf_counter() - job['started'],
+                                    operation='upload')
+
+                    # Record successful upload
+                    self._record_processed(job['summary_path'], 'upload', job['base_name'])
+
+                    self.log(f"Successfully uploaded summary: {job['summary_path']}")
+                    files_uploaded += 1
+
+            self._commit_processed()
+            if jobs:
+                self.log(f"Upload complete. Uploaded {files_uploaded} of {len(jobs)} summaries.")
                     
         except Exception as e:
-            self.log(f"Error in upload process: {str(e)}")
+            self.log(f"Error in upload process: {str(e)}", level=logging.WARNING)
+
+    def _upload_one(self, s3, job, progress):
+        """Upload a single summary PDF on a pool thread"""
+        job['started'] = time.perf_counter()
+        bucket_name = job['bucket']
+        object_key = job['key']
+        local_path = job['local_path']
+
+        # Get the shared client for the bucket's region
+        try:
+            bucket_s3 = client_registry.client_for_bucket(bucket_name)
+        except Exception as region_error:
+            self.log(f"Error getting region for bucket {bucket_name}, using default: {str(region_error)}")
+            bucket_s3 = s3
+
+        size = job['size'] = os.path.getsize(local_path)
+        progress.add_file(job['summary_path'], size)
+        report = progress.callback(job['summary_path'])
+
+        def callback(bytes_amount):
+            transfer_scheduler.throttle(bytes_amount)
+            report(bytes_amount)
+
+        # Upload the PDF file; throttling and network errors are retried by the scheduler
+        retry_options = dict(size=size, description=f"upload of {job['pdf_file']}", log=self.log,
+                             on_retry=lambda: progress.restart(job['summary_path']))
+        try:
+            transfer_scheduler.run(
+                bucket_s3.upload_file,
+                local_path, 
+                bucket_name, 
+                object_key,
+                ExtraArgs={'ACL': 'public-read'},
+                Config=TRANSFER_CONFIG,
+                Callback=callback,
+                **retry_options
+            )
+        except Exception as upload_error:
+            if bucket_s3 != s3:
+                self.log(f"Region-specific upload failed, trying with default client: {str(upload_error)}")
+                client_registry.invalidate(bucket_name)
+                progress.restart(job['summary_path'])
+                transfer_scheduler.run(s3.upload_file, local_path, bucket_name, object_key,
+                                       Config=TRANSFER_CONFIG, Callback=callback, **retry_options)
+            else:
+                raise
+
+    def _reconcile_summaries(self):
+        """Compare the upload records with the summaries actually in Wasabi and repair them.
+
+        Each summaries folder that a downloaded recording's summary belongs in (or that
+        holds a recorded upload) is listed once. Summaries found there without an upload
+        record are recorded, so they are not uploaded again; upload records whose summary
+        is gone are removed, so the next upload puts it back.
+        """
+        downloads = {row.file_path: row.local_timestamp for row in self.session.query(
+            ProcessedFile.file_path, ProcessedFile.local_timestamp).filter(ProcessedFile.operation == 'download')}
+        summary_folders = summary_folders_for(downloads)
+        expected = {}
+        for recording_path, local_timestamp in downloads.items():
+            expected.setdefault(self._get_summary_path(recording_path, summary_folders), local_timestamp)
+        recorded = {row.file_path: row.id for row in self.session.query(
+            ProcessedFile.file_path, ProcessedFile.id).filter(ProcessedFile.operation == 'upload')}
+
+        folders = {path.rsplit('/', 1)[0] for path in list(expected) + list(recorded) if path.count('/') >= 2}
+        self.log(f"Reconciling {len(recorded)} uploaded summaries against {len(folders)} summaries folders...")
+
+        remote = set()
+        listed_folders = set()
+        with ThreadPoolExecutor(max_workers=self.scan_concurrency) as pool:
+            futures = {pool.submit(self._list_summaries_folder, folder): folder for folder in sorted(folders)}
+            for future in self._iter_completed(futures):
+                folder = futures[future]
+                try:
+                    remote.update(future.result())
+                except Exception as list_error:
+                    # Records in a folder that could not be listed are left as they are
+                    self.log(f"Error listing summaries folder '{folder}': {str(list_error)}", level=logging.WARNING)
+                    continue
+                listed_folders.add(folder)
+        if self.cancelled:
+            self.log("Reconcile cancelled.")
+            return
+
+        missing = (remote & expected.keys()) - recorded.keys()
+        gone = {path for path in recorded.keys() - remote if path.rsplit('/', 1)[0] in listed_folders}
+        for path in sorted(missing):
+            self._record_processed(path, 'upload', expected[path])
+        self._commit_processed()
+        gone_ids = [recorded[path] for path in gone]
+        for start in range(0, len(gone_ids), PROCESSED_LOOKUP_CHUNK):
+            self.session.query(ProcessedFile).filter(
+                ProcessedFile.id.in_(gone_ids[start:start + PROCESSED_LOOKUP_CHUNK])).delete(synchronize_session=False)
+        self.session.commit()
+
+        metrics.inc('wasabi_reconciled_summaries_total', len(missing), action='recorded')
+        metrics.inc('wasabi_reconciled_summaries_total', len(gone), action='forgotten')
+        self.log(f"Reconcile complete. Listed {len(listed_folders)} of {len(folders)} summaries folders: "
+                 f"{len(remote & recorded.keys())} summaries in sync, {len(missing)} found without an upload "
+                 f"record, {len(gone)} recorded but missing in Wasabi.")
+
+    def _list_summaries_folder(self, folder):
+        """bucket/key paths of the objects directly in a summaries folder (bucket/prefix)"""
+        bucket_name, prefix = folder.split('/', 1)
+        bucket_s3 = client_registry.client_for_bucket(bucket_name)
+        paths = []
+        for page in self._list_pages(bucket_s3, 'reconcile', Bucket=bucket_name, Prefix=prefix + '/',
+                                     Delimiter='/'):
+            if self.cancelled:
+                raise RuntimeError("Listing cancelled")
+            paths.extend(f"{bucket_name}/{obj['Key']}" for obj in page.get('Contents', []))
+        return paths
+
+# Local files picked up by the summary watcher
+SUMMARY_EXTENSIONS = ('.txt', '.doc', '.docx', '.pdf')
+
+class LocalSummaryWatcher(QObject):
+    """Watch the upload folder and report new summaries once they are fully written.
+
+    Directory change events are debounced into one sweep of the folder, and a new or
+    rewritten file is only reported after its size and mtime stay the same between
+    two checks. Reported files are remembered in the local_seen_files table.
+    """
+    files_ready = Signal(list)
+
+    def __init__(self, parent=None, debounce_ms=250, stable_ms=500):
+        super().__init__(parent)
+        self.directory = None
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.directoryChanged.connect(self._schedule_sweep)
+        self._debounce_timer = QTimer(self)
+        self._debounce_timer.setSingleShot(True)
+        self._debounce_timer.setInterval(debounce_ms)
+        self._debounce_timer.timeout.connect(self._sweep)
+        self._stable_timer = QTimer(self)
+        self._stable_timer.setSingleShot(True)
+        self._stable_timer.setInterval(stable_ms)
+        self._stable_timer.timeout.connect(self._check_stable)
+        self._candidates = {}  # file name -> (size, mtime) at the last check
+        self._seen = {}  # file name -> (size, mtime) when it was reported
+
+    def start(self, directory):
+        self.stop()
+        self.directory = os.path.abspath(directory)
+        session = Session()
+        try:
+            self._seen = {row.file_name: (row.size, row.modified_at) for row in
+                          session.query(LocalSeenFile).filter_by(directory=self.directory)}
+        finally:
+            session.close()
+        self._watcher.addPath(self.directory)
+        self._sweep()  # Pick up files written while the watcher was not running
+
+    def stop(self):
+        if self._watcher.directories():
+            self._watcher.removePaths(self._watcher.directories())
+        self._debounce_timer.stop()
+        self._stable_timer.stop()
+        self._candidates.clear()
+
+    def _schedule_sweep(self, _path):
+        self._debounce_timer.start()
+
+    def _sweep(self):
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(SUMMARY_EXTENSIONS) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    signature = (stat.st_size, stat.st_mtime)
+                    if self._seen.get(entry.name) != signature:
+                        self._candidates[entry.name] = signature
+        except OSError:
+            return
+        if self._candidates:
+            self._stable_timer.start()
+
+    def _check_stable(self):
+        ready = []
+        for file_name, signature in list(self._candidates.items()):
+            try:
+                stat = os.stat(os.path.join(self.directory, file_name))
+            except OSError:
+                del self._candidates[file_name]
+                continue
+            current = (stat.st_size, stat.st_mtime)
+            if current == signature:
+                ready.append((file_name, current))
+                del self._candidates[file_name]
+            else:
+                self._candidates[file_name] = current  # Still being written
+
+        if ready:
+            self._mark_seen(ready)
+            self.files_ready.emit([file_name for file_name, _ in ready])
+        if self._candidates:
+            self._stable_timer.start()
+
+    def _mark_seen(self, files):
+        session = Session()
+        try:
+            rows = {row.file_name: row for row in session.query(LocalSeenFile).filter(
+                LocalSeenFile.directory == self.directory,
+                LocalSeenFile.file_name.in_([file_name for file_name, _ in files]))}
+            for file_name, (size, modified_at) in files:
+                row = rows.get(file_name)
+                if row is None:
+                    row = LocalSeenFile(directory=self.directory, file_name=file_name)
+                    session.add(row)
+                row.size = size
+                row.modified_at = modified_at
+                row.seen_at = datetime.utcnow()
+                self._seen[file_name] = (size, modified_at)
+            session.commit()
+        finally:
+            session.close()
+
+class WasabiPipeline:
+    """Runs WasabiWorker stages as a streaming producer/consumer pipeline.
+
+    run_cycle() starts the scan and download stages on their own threads, connected
+    by the persistent work queue: the scan queues each page of recordings as soon as
+    it is listed and the downloader leases them from there, so memory use does not
+    grow with the archive and a restart continues with whatever was left. Uploads run
+    on a separate thread from requests queued with request_upload(), so they never
+    wait for a scan or download.
+    """
+    def __init__(self, download_path, upload_path, start_path=None, log=print, error=print):
+        self.download_path = download_path
+        self.upload_path = upload_path
+        self.start_path = start_path
+        self.log = log
+        self.error = error
+        self.upload_requests = queue.Queue()
+        self._upload_thread = None
+        self._workers = set()  # Workers currently running, so cancel() can reach them
+        self._workers_lock = threading.Lock()
+        self._cancel_event = threading.Event()
+
+    def start(self):
+        self._upload_thread = threading.Thread(target=self._upload_loop, name='wasabi-upload', daemon=True)
+        self._upload_thread.start()
+
+    def stop(self):
+        if self._upload_thread is not None:
+            self.upload_requests.put(False)  # Stop marker
+            self._upload_thread.join()
+            self._upload_thread = None
+
+    def request_upload(self, file_names=None):
+        """Queue an upload of the given summary file names, or of the whole folder when None"""
+        self.upload_requests.put(file_names)
+
+    def cancel(self):
+        """Cancel the running cycle and upload; objects already transferring are finished first.
+
+        Upload requests made afterwards still run; the next run_cycle() starts afresh.
+        """
+        self._cancel_event.set()
+        with self._workers_lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def _run_worker(self, worker, cycle=False):
+        with self._workers_lock:
+            if cycle and self._cancel_event.is_set():
+                worker.cancel()  # The cycle was cancelled before this stage started
+            self._workers.add(worker)
+        try:
+            worker.start()
+        finally:
+            with self._workers_lock:
+                self._workers.discard(worker)
+
+    def run_cycle(self):
+        """Run one streaming scan -> download (-> transcode) cycle, then queue an upload of the whole folder"""
+        self._cancel_event.clear()
+        scan_finished = threading.Event()
+
+        download_finished = threading.Event()
+
+        scanner = WasabiWorker('scan', destination_path=self.download_path, start_path=self.start_path)
+        downloader = WasabiWorker('download', destination_path=self.download_path)
+        downloader.scan_finished = scan_finished
+        if self.upload_path:
+            downloader.upload_requested = self.request_upload
+        downloaded_paths = downloader.downloaded_paths = {}
+        scanner.set_callbacks(self.log, scan_finished.set, self.error)
+        downloader.set_callbacks(self.log, download_finished.set, self.error)
+
+        threads = [threading.Thread(target=self._run_worker, args=(downloader, True), name='wasabi-download'),
+                   threading.Thread(target=self._run_worker, args=(scanner, True), name='wasabi-scan')]
+        if TRANSCODE:
+            # Recordings are converted while the rest are still downloading
+            transcoder = WasabiWorker('transcode', destination_path=self.download_path)
+            transcoder.download_finished = download_finished
+            transcoder.downloaded_paths = downloaded_paths
+            transcoder.set_callbacks(self.log, None, self.error)
+            threads.append(threading.Thread(target=self._run_worker, args=(transcoder, True),
+                                            name='wasabi-transcode'))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.upload_path and not self.cancelled:
+            self.request_upload()
+
+    def _upload_loop(self):
+        while True:
+            request = self.upload_requests.get()
+            metrics.set_gauge('wasabi_queue_depth', self.upload_requests.qsize(), queue='upload_requests')
+            if request is False:
+                return
+
+            # Merge everything queued meanwhile into one upload run
+            file_names = None if request is None else set(request)
+            stop = False
+            while True:
+                try:
+                    request = self.upload_requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is False:
+                    stop = True
+                elif request is None:
+                    file_names = None
+                elif file_names is not None:
+                    file_names.update(request)
+
+            uploader = WasabiWorker('upload', source_path=self.upload_path)
+            if file_names is not None:
+                uploader.specific_files = sorted(file_names)
+            uploader.set_callbacks(self.log, None, self.error)
+            self._run_worker(uploader)
+            if stop:
+                return
+
+def _console_log(message):
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}", flush=True)
+
+def _console_error(message):
+    _console_log(f"Error: {message}")
+
+def run_headless(argv=None):
+    """Run scan/download/upload cycles without the GUI, e.g. as a service on a server"""
+    parser = argparse.ArgumentParser(description="Theta Recording Manager without the GUI")
+    parser.add_argument('--headless', action='store_true', help="run without the GUI")
+    parser.add_argument('--download-path', help="folder recordings are downloaded to (not needed with --reconcile)")
+    parser.add_argument('--upload-path', required=True, help="folder summaries are uploaded from")
+    parser.add_argument('--start-path', default='', help="only scan below this path in each bucket")
+    parser.add_argument('--interval', type=float, default=5, help="minutes between scans (default: 5)")
+    parser.add_argument('--once', action='store_true', help="run a single cycle and exit")
+    parser.add_argument('--reconcile', action='store_true',
+                        help="compare the upload records with the summaries folders in Wasabi, repair them, "
+                             "upload summaries missing in Wasabi again and exit")
+    args = parser.parse_args(argv)
+    if not args.reconcile and not args.download_path:
+        parser.error("the following arguments are required: --download-path")
+
+    setup_file_logging()
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+    stop_metrics = start_metrics_exporters(_console_log)
+
+    if args.reconcile:
+        reconciler = WasabiWorker('reconcile', source_path=args.upload_path)
+        errors = []
+
+        def reconcile_error(message):
+            errors.append(message)
+            _console_error(message)
+
+        reconciler.set_callbacks(_console_log, None, reconcile_error)
+        reconciler.start()
+        stop_metrics()
+        return 1 if errors else 0
+    pipeline = WasabiPipeline(args.download_path, args.upload_path, start_path=args.start_path,
+                              log=_console_log, error=_console_error)
+    pipeline.start()
+
+    if args.once:
+        pipeline.run_cycle()
+        pipeline.stop()
+        stop_metrics()
+        return 0
+
+    # New summaries are uploaded as soon as they are written
+    watcher = LocalSummaryWatcher()
+    watcher.files_ready.connect(pipeline.request_upload)
+    watcher.start(args.upload_path)
+
+    stop_event = threading.Event()
+
+    def cycle_loop():
+        while not stop_event.is_set():
+            try:
+                pipeline.run_cycle()
+            except Exception as e:
+                _console_error(str(e))
+            stop_event.wait(args.interval * 60)
+
+    cycle_thread = threading.Thread(target=cycle_loop, name='wasabi-cycle', daemon=True)
+    cycle_thread.start()
+
+    # Let Ctrl+C / SIGTERM stop the Qt event loop; the timer gives Python a chance to run handlers
+    signal.signal(signal.SIGINT, lambda *_: app.quit())
+    signal.signal(signal.SIGTERM, lambda *_: app.quit())
+    signal_timer = QTimer()
+    signal_timer.timeout.connect(lambda: None)
+    signal_timer.start(500)
+
+    _console_log(f"Running headless: scanning every {args.interval:g} minutes. Press Ctrl+C to stop.")
+    app.exec()
+
+    _console_log("Stopping...")
+    stop_event.set()
+    watcher.stop()
+    pipeline.cancel()
+    cycle_thread.join()
+    pipeline.stop()
+    stop_metrics()
+    return 0
+
+class _CycleThread(QThread):
+    """QThread running a single WasabiPipeline cycle"""
+    def __init__(self, pipeline, parent=None):
+        super().__init__(parent)
+        self.pipeline = pipeline
+
+    def run(self):
+        try:
+            self.pipeline.run_cycle()
+        except Exception as e:
+            self.pipeline.error(str(e))
+
+class PipelineBridge(QObject):
+    """Runs a WasabiPipeline off the GUI thread and relays its output through Qt signals.
+
+    Cycles run on a QThread and uploads on the pipeline's own thread. Their log
+    messages are buffered and emitted as one `progress` batch every interval_ms, so a
+    busy scan cannot flood the event loop; errors are emitted as they happen.
+    """
+    progress = Signal(list)
+    error = Signal(str)
+    cycle_finished = Signal()
+
+    def __init__(self, parent=None, interval_ms=100):
+        super().__init__(parent)
+        self.pipeline = WasabiPipeline(None, None, log=self.log, error=self.error.emit)
+        self._messages = deque(maxlen=UI_LOG_LINES)  # Older lines would be dropped by the view anyway
+        self._cycle_thread = None
+        self._flush_timer = QTimer(self)
+        self._flush_timer.timeout.connect(self._flush)
+        self._flush_timer.start(interval_ms)
+        self.pipeline.start()
+
+    def log(self, message):
+        """Queue a message for the next progress batch; safe to call from any thread"""
+        # Timestamped when logged, not when the batch reaches the GUI
+        self._messages.append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}")
+
+    def _flush(self):
+        batch = []
+        while self._messages:
+            batch.append(self._messages.popleft())
+        if batch:
+            self.progress.emit(batch)
+
+    def is_running(self):
+        return self._cycle_thread is not None
+
+    def run_cycle(self, download_path, upload_path, start_path):
+        """Start a scan -> download -> upload cycle in the background; False if one is running"""
+        if self.is_running():
+            return False
+        self.pipeline.download_path = download_path
+        self.pipeline.upload_path = upload_path
+        self.pipeline.start_path = start_path
+        self._cycle_thread = _CycleThread(self.pipeline, self)
+        self._cycle_thread.finished.connect(self._cycle_done)
+        self._cycle_thread.start()
+        return True
+
+    def _cycle_done(self):
+        self._cycle_thread.deleteLater()
+        self._cycle_thread = None
+        self._flush()
+        self.cycle_finished.emit()
+
+    def request_upload(self, upload_path, file_names=None):
+        self.pipeline.upload_path = upload_path
+        self.pipeline.request_upload(file_names)
+
+    def cancel(self):
+        self.pipeline.cancel()
+
+    @property
+    def cancelled(self):
+        return self.pipeline.cancelled
+
+    def shutdown(self):
+        """Cancel running work and wait for transfers in progress to finish"""
+        self.pipeline.cancel()
+        if self._cycle_thread is not None:
+            self._cycle_thread.wait()
+        self.pipeline.stop()
+        self._flush_timer.stop()
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -407,16 +3495,21 @@ class MainWindow(QMainWindow):
         self.path_input.setPlaceholderText("Enter starting path (e.g., folder1/subfolder/) or leave empty for full scan")
         self.scan_button = QPushButton("Start Scan")
         self.scan_button.clicked.connect(self.start_scan)
+        self.stop_button = QPushButton("Stop")
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.cancel_operation)
         path_layout.addWidget(QLabel("Starting Path:"))
         path_layout.addWidget(self.path_input)
         path_layout.addWidget(self.scan_button)
+        path_layout.addWidget(self.stop_button)
         layout.addLayout(path_layout)
 
         # Create UI elements
         self.status_label = QLabel("Ready")
         self.progress_bar = QProgressBar()
-        self.log_text = QTextEdit()
+        self.log_text = QPlainTextEdit()
         self.log_text.setReadOnly(True)
+        self.log_text.setMaximumBlockCount(UI_LOG_LINES)  # Oldest lines are dropped; the log file has them all
 
         # Create path selection layout
         paths_layout = QVBoxLayout()
@@ -468,19 +3561,26 @@ class MainWindow(QMainWindow):
         self.download_path = None
         self.upload_path = None
 
-        # Initialize worker and timer
-        self.current_worker = None
+        # Scans, downloads and uploads run in the background and report back through signals
+        self.pipeline_bridge = PipelineBridge(self)
+        self.pipeline_bridge.progress.connect(self.log_messages)
+        self.pipeline_bridge.error.connect(self.handle_error)
+        self.pipeline_bridge.cycle_finished.connect(self.operation_finished)
+        self.stop_metrics = start_metrics_exporters(self.pipeline_bridge.log)
         self.scan_timer = QTimer()
         self.scan_timer.timeout.connect(self.start_scan)
 
-        # Add local scan timer
-        self.local_scan_timer = QTimer()
-        self.local_scan_timer.timeout.connect(self.check_local_files)
-        self.local_scan_timer.setInterval(10000)  # 10 seconds
-        self.previously_found_files = set()
+        # Watch the upload folder for new summaries
+        self.summary_watcher = LocalSummaryWatcher(self)
+        self.summary_watcher.files_ready.connect(self.upload_new_summaries)
 
     def log_message(self, message):
-        self.log_text.append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}")
+        logger.info(message)
+        self.log_text.appendPlainText(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}")
+
+    def log_messages(self, messages):
+        """Append a batch of already timestamped messages in one update"""
+        self.log_text.appendPlainText('\n'.join(messages))
 
     def set_download_path(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Auto-Download Destination")
@@ -507,21 +3607,21 @@ class MainWindow(QMainWindow):
             self.set_upload_path_button.setEnabled(False)
             self.start_scan()  # Start first scan immediately
             self.scan_timer.start(self.refresh_rate.value() * 60 * 1000)  # Convert minutes to milliseconds
-            self.local_scan_timer.start()  # Start local file scanning
+            self.summary_watcher.start(self.upload_path)  # Start watching for new summaries
         else:
             self.auto_scan_button.setText("Start Auto-Processing")
             self.refresh_rate.setEnabled(True)
             self.set_download_path_button.setEnabled(True)
             self.set_upload_path_button.setEnabled(True)
             self.scan_timer.stop()
-            self.local_scan_timer.stop()
+            self.summary_watcher.stop()
 
     def update_timer(self):
         if self.scan_timer.isActive():
             self.scan_timer.setInterval(self.refresh_rate.value() * 60 * 1000)
 
     def start_scan(self):
-        if self.current_worker is not None:
+        if self.pipeline_bridge.is_running():
             return  # Don't start a new scan if one is already running
         
         # Check if download path is set
@@ -532,72 +3632,31 @@ class MainWindow(QMainWindow):
         # Get the starting path from the input field
         start_path = self.path_input.text().strip()
         
-        # Create and configure the worker
-        self.current_worker = WasabiWorker('scan', destination_path=self.download_path, start_path=start_path)
-        self.current_worker.set_callbacks(
-            progress_cb=self.log_message,
-            finished_cb=self.scan_finished,
-            error_cb=self.handle_error
-        )
-        
-        # Start the scan
-        self.current_worker.start()
-        self.status_label.setText("Scanning for recordings...")
+        # Scan, download and upload on background threads
+        self.pipeline_bridge.run_cycle(self.download_path, self.upload_path, start_path)
+        self.status_label.setText("Scanning and downloading recordings...")
         self.progress_bar.setRange(0, 0)
         self.scan_button.setEnabled(False)
+        self.stop_button.setEnabled(True)
 
-    def scan_finished(self):
-        self.scan_button.setEnabled(True)  # Re-enable scan button
-        if self.current_worker and self.current_worker.found_recordings:
-            # Start download operation
-            self.start_download(self.current_worker.found_recordings)
-        else:
-            self.operation_finished()
-
-    def start_download(self, recordings):
-        if not recordings:
-            self.operation_finished()
-            return
-
-        self.current_worker = WasabiWorker('download', destination_path=self.download_path)
-        self.current_worker.found_recordings = recordings
-        self.current_worker.set_callbacks(
-            progress_cb=self.log_message,
-            finished_cb=self.download_finished,
-            error_cb=self.handle_error
-        )
-        
-        self.current_worker.start()
-        self.status_label.setText("Downloading recordings...")
-        self.progress_bar.setRange(0, 0)
-
-    def download_finished(self):
-        # Start upload operation
-        self.start_upload()
-
-    def start_upload(self):
-        self.current_worker = WasabiWorker('upload', source_path=self.upload_path)
-        self.current_worker.set_callbacks(
-            progress_cb=self.log_message,
-            finished_cb=self.operation_finished,
-            error_cb=self.handle_error
-        )
-        
-        self.current_worker.start()
-        self.status_label.setText("Uploading summaries...")
-        self.progress_bar.setRange(0, 0)
+    def cancel_operation(self):
+        self.pipeline_bridge.cancel()
+        self.status_label.setText("Cancelling - finishing transfers in progress...")
+        self.stop_button.setEnabled(False)
 
     def operation_finished(self):
-        # Clean up the finished worker
-        if self.current_worker:
-            self.current_worker = None
-        
         # Update UI
-        self.status_label.setText("Operation completed")
-        self.progress_bar.setRange(0, 100)
-        self.progress_bar.setValue(100)
+        if self.pipeline_bridge.cancelled:
+            self.status_label.setText("Operation cancelled")
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(0)
+        else:
+            self.status_label.setText("Operation completed")
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(100)
         
         self.scan_button.setEnabled(True)  # Re-enable scan button
+        self.stop_button.setEnabled(False)
 
     def handle_error(self, error_message):
         self.status_label.setText("Error occurred")
@@ -608,46 +3667,29 @@ class MainWindow(QMainWindow):
         if self.auto_scan_button.isChecked():
             self.auto_scan_button.click()  # Stop auto-scan on error
 
-    def check_local_files(self):
-        """Scan local storage every 10 seconds for new files to upload"""
-        if not self.upload_path:
-            return
-
-        current_files = set()
-        for file_name in os.listdir(self.upload_path):
-            if file_name.endswith(('.txt', '.doc', '.docx', '.pdf')):
-                current_files.add(file_name)
-
-        # Find new files
-        new_files = current_files - self.previously_found_files
-        if new_files:
-            self.log_message(f"Found {len(new_files)} new summary files. Starting upload...")
-            self.start_upload_specific(list(new_files))
-
-        self.previously_found_files = current_files
-
-    def start_upload_specific(self, specific_files):
-        self.current_worker = WasabiWorker('upload', source_path=self.upload_path)
-        self.current_worker.specific_files = specific_files
-        self.current_worker.set_callbacks(
-            progress_cb=self.log_message,
-            finished_cb=self.operation_finished,
-            error_cb=self.handle_error
-        )
-        
-        self.current_worker.start()
-        self.status_label.setText("Uploading new summaries...")
-        self.progress_bar.setRange(0, 0)
+    def upload_new_summaries(self, file_names):
+        """Upload summaries reported by the folder watcher; runs alongside any scan or download"""
+        self.log_message(f"Found {len(file_names)} new summary files. Starting upload...")
+        self.pipeline_bridge.request_upload(self.upload_path, file_names)
 
     def closeEvent(self, event):
-        # Stop timers only
         if hasattr(self, 'scan_timer'):
             self.scan_timer.stop()
-        if hasattr(self, 'local_scan_timer'):
-            self.local_scan_timer.stop()
+        if hasattr(self, 'summary_watcher'):
+            self.summary_watcher.stop()
+        # Stop background work; transfers already in progress are finished first
+        if hasattr(self, 'pipeline_bridge'):
+            self.status_label.setText("Stopping - finishing transfers in progress...")
+            self.pipeline_bridge.shutdown()
+        if hasattr(self, 'stop_metrics'):
+            self.stop_metrics()
         event.accept()
 
 if __name__ == '__main__':
+    if '--headless' in sys.argv[1:]:
+        sys.exit(run_headless(sys.argv[1:]))
+
+    setup_file_logging()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()